@@ -1,104 +1,163 @@
 #!/usr/bin/env python3
 
 import subprocess as sp
-import io
 import getopt
 import os
-import imp
 import sys
-import audioop
 import time
-import traceback
 import threading
+import traceback
 import json
+import collections
+import re
+import functools
 from builtin import *
 import handles
+from dsp import DSP
+from cache import PCMCache, LoudnessStore, cache_key
+from probe import Prober
+from commands import CommandExecutor
+from loader import BotModule, read_manifest
+from metrics import Registry, MetricsServer
+from profiler import Profiler
+import opus
 
 SCRIPTPATH = os.path.dirname(__file__)
 # Add pymumble folder to python PATH for importing
 sys.path.append(os.path.join(SCRIPTPATH, 'pymumble'))
 import pymumble_py3 as pymumble
 
-PIDFILE = '/tmp/mj.pid'
+FRAME_LENGTH = handles.FRAME_LENGTH
+FRAME_SIZE = handles.FRAME_SIZE
+AUDIO_LEAD = 0.1  # Seconds of audio kept queued in pymumble's sound output
+BUFFER_BUCKETS = (0.0, 0.02, 0.04, 0.06, 0.08, 0.1, 0.12, 0.16, 0.2, 0.5)
+ADMIN_COMMANDS = {'profile'}
+STREAMS_PER_BOT = 2  # Leaves a bot's streams hold workers for, the playing one and the next
+HEADER_TAIL = 64  # Bytes of ffmpeg's stderr kept to find a duration split between two reads
+MIN_LOUDNESS_SECONDS = 3.0  # Audio measured before ebur128's running loudness is used
+# Line of ebur128's frame log, with the seconds measured and the integrated loudness so far
+LOUDNESS_FRAME = re.compile(rb'\[Parsed_ebur128_\d+ @ [^\]\n]*\] t: *([0-9.]+) [^\n]*? I: *(-?[0-9.]+) LUFS[^\n]*\n')
+EXIT_TIMEOUT = 5  # Seconds ffmpeg gets to exit on its own once its output was read
+
 
+def parse_arguments(config):
+    """Returns the connection parameters given on the command line, or else in
+    config.json, and the usernames of the bots to run: the one given with
+    --user, or the first --bots of the config's list, all of them by default
+    """
+    parameters = {}
+    arglist = ['server=', 'port=', 'user=', 'password=', 'certfile=',
+               'reconnect=', 'debug=', 'quiet=', 'bots=']
+    try:
+        opt, arg = getopt.getopt(sys.argv[1:], '', arglist)
+        for arg_value in opt:
+            parameters[arg_value[0][2:]] = arg_value[1]
+    except getopt.GetoptError:
+        sys.exit('usage: MumbleJumble.py --argument1 <value> --argument2 <value>')
+
+    for arg in arglist[:-1]:
+        arg = arg[:-1]
+        if arg not in parameters and arg != 'user':
+            parameters[arg] = config['bot'][arg]
 
-def num_scripts():
-    if os.path.isfile(PIDFILE):
-        with open(PIDFILE) as f:
-            return len(f.readlines())
-    return 0
+    if 'user' in parameters:
+        users = [parameters.pop('user')]
+    else:
+        users = config['bot']['user']
+        if isinstance(users, str):
+            users = [users]
+    if 'bots' in parameters:
+        try:
+            users = users[:int(parameters.pop('bots'))]
+        except ValueError:
+            sys.exit('--bots must be a number')
+    return parameters, users
 
 
-def writepid():
-    mode = 'a' if os.path.isfile(PIDFILE) else 'w'
-    with open(PIDFILE, mode) as f:
-        f.write(str(os.getpid()) + '\n')
-        
+class Supervisor:
+    """Hosts the bots of the process and what they share: the decoder pool,
+    the PCM, Opus and loudness caches, the probe cache, the profiler and the
+    objects the modules share through shared()
+    """
+    def __init__(self, config):
+        self.config = config
+        self.bots = []
+        self.lock = threading.Lock()
+        self.objects = {}  # Name to object shared by the bots' modules
+        self.metrics = Registry()
+        self.metrics_server = MetricsServer.from_config(self.metrics, self.config)
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        self.pcm_cache = PCMCache.from_config(self.config)
+        self.loudness = LoudnessStore.from_config(self.config)
+        self.opus_cache = opus.OpusCache.from_config(self.config) if self.pcm_cache is not None else None
+        self.opus_encoder = None
+        if self.opus_cache is not None:
+            self.opus_encoder = opus.OpusEncodeThread(self.pcm_cache, self.opus_cache)
+            self.opus_encoder.start()
+        self.prober = Prober()
+        self.decoders = DecoderPool(self)
+        self.decoders.start()
+        self.commands = CommandExecutor.from_config(self.config, self.metrics)
+        self.commands.start()
+        self.profiler = Profiler.from_config(self.config)
+        for name, cache in (('pcm', self.pcm_cache), ('opus', self.opus_cache)):
+            if cache is not None:
+                self.metrics.gauge('mj_cache_bytes', 'Size of the caches on disk').set_function(
+                    functools.partial(getattr, cache, 'size'), cache=name)
 
-def deletepid():
-    with open(PIDFILE, 'r') as f:
-        lines = f.readlines()
-    with open(PIDFILE, 'w') as f:
-        for line in lines:
-            if line != str(os.getpid()) + '\n':
-                f.write(line)
+    def shared(self, name, factory):
+        """Returns the object shared by the bots under name, made by calling
+        factory the first time. A thread is made again once it stopped.
+        """
+        with self.lock:
+            obj = self.objects.get(name)
+            if obj is None or (isinstance(obj, threading.Thread) and not obj.is_alive()):
+                obj = self.objects[name] = factory()
+            return obj
 
+    def start_bot(self, user, parameters):
+        """Connects a bot under the username user and starts it playing"""
+        bot = MumbleJumble(self, user, parameters)
+        self.bots.append(bot)
+        self.decoders.fit(len(self.bots))
+        self.decoders.wake()  # For what its modules queued before it was listed
+        bot.start()
+        return bot
 
-class MJModule:
-    """Object of MumbleJumble's modules"""
-    def __init__(self):
-        pass
+    def run(self):
+        """Keeps the main thread alive while the bots play"""
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            sys.exit('Exiting!')
 
 
 class MumbleJumble:
     """Represents the Mumble client interacting with users and outputting sound
     """
-    def __init__(self):
-        with open(os.path.join(SCRIPTPATH, 'config.json')) as json_config_file:
-            self.config = json.load(json_config_file)
-
-        pymumble_parameters = {}
-        arglist = ['server=', 'port=', 'user=', 'password=', 'certfile=', 
-                   'reconnect=', 'debug=', 'quiet=']
+    def __init__(self, supervisor, user, parameters):
+        self.supervisor = supervisor
+        self.config = supervisor.config
+        self.user = user
 
-        self.config_username = False
-
-        try:
-            opt, arg = getopt.getopt(sys.argv[1:], '', arglist)
-            for arg_value in opt:
-                pymumble_parameters[arg_value[0][2:]] = arg_value[1]
-        except getopt.GetoptError:
-            sys.exit('usage: MumbleJumble.py --argument1 <value> --argument2 <value>')
-
-        for arg in arglist:
-            arg = arg[:-1]
-            if arg not in pymumble_parameters:
-                if arg == 'user':
-                    try:
-                        pymumble_parameters[arg] = self.config['bot'][arg][num_scripts()]
-                        writepid()
-                        self.config_username = True
-                    except IndexError:
-                        print('Usernames already taken by other MumbleJumble scripts')
-                        sys.exit('''If you think this is an error, try deleting {0} and restarting all MumbleJumble instances'''.format(PIDFILE))
-                else:
-                    pymumble_parameters[arg] = self.config['bot'][arg]
-
-        self.client = pymumble.Mumble(host=pymumble_parameters['server'],
-                                      port=int(pymumble_parameters['port']),
-                                      user=pymumble_parameters['user'], 
-                                      password=pymumble_parameters['password'],
-                                      certfile=pymumble_parameters['certfile'],
-                                      reconnect=pymumble_parameters['reconnect'], 
-                                      debug=pymumble_parameters['debug'])
+        self.client = pymumble.Mumble(host=parameters['server'],
+                                      port=int(parameters['port']),
+                                      user=user,
+                                      password=parameters['password'],
+                                      certfile=parameters['certfile'],
+                                      reconnect=parameters['reconnect'],
+                                      debug=parameters['debug'])
 
         # Sets to client to call command_received when a user sends text
         self.client.callbacks.set_callback('text_received', self.command_received)
 
-        self.queue = Queues()
+        self.queue = Queues(supervisor.decoders.wake)
         # Shortcuts for API
         self.build_mirror = self.queue.build_mirror
         self.append_audio = self.queue.append_audio
+        self.shared = supervisor.shared
 
         self.client.start()  # Start the mumble thread
 
@@ -106,108 +165,174 @@ class MumbleJumble:
             self.volume = float(self.config['bot']['volume'])
         except (KeyError, ValueError):
             self.volume = 1.00
-        self.quiet = pymumble_parameters['quiet']  # Is in this dict since it is a cmd line arg
-                                                   # Will change it if there are more cmd line args in the future
+        self.quiet = parameters['quiet']  # Is in this dict since it is a cmd line arg
+                                          # Will change it if there are more cmd line args in the future
         self.paused = False
         self.skipLeaf = False
         self.skipBranch = False
         self.leaf = None
-        self.reload_count = 0
+        self.clock = AudioClock(FRAME_LENGTH)
+        self.dsp = DSP(FRAME_SIZE, self.volume, **self.config.get('audio', {}))
+        self.modules = {}  # Name to BotModule
+        self.register_metrics(supervisor.metrics)
         self.client.is_ready()  # Wait for the connection
         self.client.set_bandwidth(200000)
         try:
             self.client.users.myself.unmute()  # Be sure the client is not muted
         except AttributeError:
             # Raises AttributeError if it hasn't connected to the server
-            sys.exit('Could not connect to server, are you sure it is set properly?')
+            raise ConnectionError("Could not connect to server as '{0}', are you sure it is set properly?"
+                                  .format(user))
         with open(os.path.join(SCRIPTPATH, 'comment')) as comment:
             self.client.users.myself.comment(comment.read())
 
+        # Shared with the other bots of the supervisor
+        self.pcm_cache = supervisor.pcm_cache
+        self.loudness = supervisor.loudness
+        self.opus_cache = supervisor.opus_cache
+        self.opus_encoder = supervisor.opus_encoder
+        self.decoders = supervisor.decoders
+        self.commands = supervisor.commands
+
         self.load_modules()
 
-        self.ffmpegthread = FfmpegThread(self)
-        self.ffmpegthread.start()
+        try:
+            probing = self.config['ffmpeg']['probe']
+        except KeyError:
+            probing = True
+        if probing:
+            self.probethread = ProbeThread(self, supervisor.prober)
+            self.probethread.start()
 
         self.loopthread = LoopThread(self)
         self.loopthread.start()
 
-        self.audio_loop()  # Loops the main thread
+    def start(self):
+        """Starts the audio loop in a thread of its own"""
+        self.audiothread = threading.Thread(target=self.audio_loop, name='audio_loop ' + self.user, daemon=True)
+        self.audiothread.start()
+
+    def register_metrics(self, metrics):
+        """Adds the bot's playback metrics to the registry, labelled with its
+        username
+        """
+        self.first_audio = metrics.histogram('mj_first_audio_seconds',
+                                             'Time from queueing a leaf to its first frame being sent')
+        self.buffer_level = metrics.histogram('mj_output_buffer_seconds',
+                                              "Audio queued in pymumble's sound output, sampled every frame",
+                                              BUFFER_BUCKETS)
+        sound_output = lambda: self.client.sound_output.get_buffer_size()
+        metrics.gauge('mj_output_buffered_seconds', "Audio queued in pymumble's sound output").set_function(
+            sound_output, bot=self.user)
+        metrics.counter('mj_underruns_total', 'Times the sound output ran dry while playing').set_function(
+            lambda: self.clock.underruns, bot=self.user)
+        metrics.counter('mj_frames_total', 'Frames sent').set_function(lambda: self.clock.ticks, bot=self.user)
+        metrics.gauge('mj_jitter_max_seconds', 'Largest lateness of the audio loop').set_function(
+            lambda: self.clock.jitter_max, bot=self.user)
+        for name in ('ffmpeg', 'audio'):
+            metrics.gauge('mj_queue_leaves', 'Leaves waiting in the queues').set_function(
+                functools.partial(self.queue_leaves, name), bot=self.user, queue=name)
+        for index, kind in enumerate(('memory', 'mapped')):
+            metrics.gauge('mj_leaf_pcm_bytes', 'Decoded audio held by the queued and playing leaves').set_function(
+                lambda index=index: self.held_bytes()[index], bot=self.user, kind=kind)
+
+    def queue_leaves(self, name):
+        """Returns the number of leaves in the ffmpeg or audio queue"""
+        audio, ffmpeg = self.queue.snapshot()
+        if name == 'ffmpeg':
+            return len(ffmpeg)
+        return sum(x.count() if isinstance(x, handles.Branch) else 1 for x in audio)
+
+    def held_bytes(self):
+        """Returns the bytes of decoded audio held in memory and mapped from
+        the cache by the queued and playing leaves
+        """
+        audio, ffmpeg = self.queue.snapshot()
+        leaves = set(ffmpeg)
+        for x in audio:
+            leaves.update(x if isinstance(x, handles.Branch) else (x,))
+        if self.leaf is not None:
+            leaves.add(self.leaf)
+        held = [leaf.held_bytes() for leaf in leaves]
+        return sum(x[0] for x in held), sum(x[1] for x in held)
 
     def load_modules(self):
+        """Registers the commands of the modules in modules/ from their
+        manifest, a module is only imported once one of its commands is used
+        unless it is not lazy. Called again, only the modules whose file was
+        added, changed or removed, or which failed to load, are unloaded and
+        registered again, the others keep running. Returns how many modules
+        that was.
+        """
         print('\nLoading bot modules')
-        self.registered_commands = {'c': clear_queue,
-                                    'clear': clear_queue,
-                                    'p': toggle_pause,
-                                    'pause': toggle_pause,
-                                    'q': print_queue,
-                                    'queue': print_queue,
-                                    'r': reload_modules,
-                                    'reload': reload_modules,
-                                    's': skip,
-                                    'seek': seek,
-                                    'skip': skip,
-                                    'v': chg_vol,
-                                    'vol': chg_vol,
-                                    'volume': chg_vol}
-        self.registered_modules = []  # List of module objects
+        commands = {'c': clear_queue,
+                    'clear': clear_queue,
+                    'p': toggle_pause,
+                    'pause': toggle_pause,
+                    'profile': profile,
+                    'q': print_queue,
+                    'queue': print_queue,
+                    'r': reload_modules,
+                    'reload': reload_modules,
+                    's': skip,
+                    'seek': seek,
+                    'skip': skip,
+                    'stats': print_stats,
+                    'v': chg_vol,
+                    'vol': chg_vol,
+                    'volume': chg_vol}
 
         # Lists modules
-        filenames = []
-        for fn in os.listdir(os.path.join(SCRIPTPATH, 'modules')):
+        filenames = {}
+        for fn in sorted(os.listdir(os.path.join(SCRIPTPATH, 'modules'))):
             if fn.endswith('.py') and not fn.startswith('_'):
-                filenames.append(os.path.join(SCRIPTPATH, 'modules', fn))
+                filenames[fn[:-3]] = os.path.join(SCRIPTPATH, 'modules', fn)
+
+        changed = 0
+        for name in list(self.modules):
+            if name not in filenames:
+                self.modules.pop(name).unload()
+                changed += 1
 
-        # Tries to import modules
-        modules = []
-        for filename in filenames:
-            name = os.path.basename(filename)[:-3]
+        # Reads the manifests of new or changed modules
+        for name, filename in filenames.items():
             try:
-                module = imp.load_source(name, filename)
-            except Exception as e:
+                manifest = read_manifest(filename)
+            except (OSError, SyntaxError) as e:
                 print('Could not load module ' + name)
                 print('  ' + str(e))
+                manifest = None
+            current = self.modules.get(name)
+            if current is not None:
+                if manifest is not None and manifest.signature == current.manifest.signature and \
+                        not current.failed:
+                    continue
+                self.modules.pop(name).unload()
+            changed += 1
+            if manifest is None or not manifest.enabled:
                 continue
-            modules.append(module)
-
-        # Registers modules and creates modules objects
-        for module in modules:
-            try:
-                if hasattr(module, 'register'):
-                    if hasattr(module.register, 'enabled') and not module.register.enabled:
-                        continue
-
-                    print('Loading module ', module.__name__)
-                    module.register(self)
-
-                    module_object = MJModule()
-
-                    l = ['call', 'loop', 'queue_append']
-                    for attr in l:
-                        try:
-                            value = getattr(module, attr)
-                            setattr(module_object, attr, value)
-                        except AttributeError:
-                            continue
-
-                    self.registered_modules.append(module_object)
-
-                    try:
-                        for command in module.register.commands:
-                            if command in self.registered_commands.keys():
-                                print('Command "{0}" already registered'.format(command), file=sys.stderr)
-                            else:
-                                print("  Registering '{0}' - for module '{1}'".format(command, module.__name__))
-                                self.registered_commands[command] = module_object.call
-                    except TypeError:
-                        print("  No commands registered for module '{0}'".format(module.__name__))
+            if not manifest.register:
+                print("Could not register '{0}', for it is missing the 'register' function".format(name),
+                      file=sys.stderr)
+                continue
+            module = BotModule(self, manifest)
+            self.modules[name] = module
+            if not manifest.lazy:
+                module.load()
 
+        # Registers the modules' commands
+        for module in self.modules.values():
+            module_commands = module.commands()
+            if not module_commands:
+                print("  No commands registered for module '{0}'".format(module.name))
+            for command in module_commands:
+                if command in commands:
+                    print('Command "{0}" already registered'.format(command), file=sys.stderr)
                 else:
-                    print("Could not register '{0}', for it is missing the 'register' function".format(module),
-                          file=sys.stderr)
-            except Exception as e:
-                print("Error registering module '{0}'".format(module.__name__))
-                traceback.print_exc()
-        return len(modules)
+                    commands[command] = module.call
+        self.registered_commands = commands
+        print('  Registered {0} commands for {1} modules'.format(len(commands), len(self.modules)))
+        return changed
 
     def get_current_channel(self):
         """Get the client's current channel (dict)"""
@@ -223,116 +348,674 @@ class MumbleJumble:
             self.get_current_channel().send_text_message(msg)
 
     def command_received(self, text):
-        """Main function that reads commands in chat and outputs accordingly
+        """Main function that reads commands in chat and queues them to be run
+        by the command executor, off pymumble's thread
         Takes text, a class from pymumble.mumble_pb2. Commands have to start with a !
         """
         message = text.message.lstrip().split(' ', 1)
         if message[0].startswith('!'):
             command = message[0][1:]
             arguments = ''.join(message[1]).strip(' ') if len(message) > 1 else ''
-            try:
-                self.registered_commands[command](self, command, arguments)
-            except KeyError:
-                pass
+            function = self.registered_commands.get(command)
+            if function is not None and command in ADMIN_COMMANDS and not self.is_admin(text.actor):
+                self.send_msg_current_channel('<b>!{0}</b> is for admins only'.format(command))
+            elif function is not None:
+                self.commands.submit(self, self.get_user_name(text.actor), command, arguments, function)
+
+    def get_user_name(self, session):
+        """Returns the name of the user with the given session"""
+        try:
+            return self.client.users[session]['name']
+        except KeyError:
+            return str(session)
      
+    def is_admin(self, session):
+        """Whether the user with the given session is registered on the server
+        under one of the names in the config's admins
+        """
+        try:
+            user = self.client.users[session]
+            admins = self.config['bot']['admins']
+        except KeyError:
+            return False
+        return user['name'] in admins and user.get('user_id') is not None
+
+    def wake(self):
+        """Wakes the audio loop up after pausing, skipping or clearing"""
+        self.queue.notify()
+
     def audio_loop(self):
-        """Main loop that sends audio samples to the server. Sends the first
+        """Main loop that sends audio samples to the server. Plays the first
+        leaf of the audio queue and sleeps on the queue's condition while there
+        is nothing to play.
         """
         while True:
             try:
-                if self.queue.audio:
-                    try:
-                        self.leaf = self.queue.audio[0].leaves[0]
-                    except AttributeError:
-                        self.leaf = self.queue.audio[0]
-                    while self.leaf.current_sample <= self.leaf.total_samples:
-                        while self.paused:
-                            time.sleep(0.1)
-                        while self.client.sound_output.get_buffer_size() > 0.5:
-                            time.sleep(0.1)
-                        if not self.skipLeaf:
-                            self.client.sound_output.add_sound(audioop.mul(
-                                            self.leaf.samples[self.leaf.current_sample],
-                                            2, self.volume))
-                            self.leaf.current_sample += 1
-                        elif self.skipLeaf:
-                            self.skipLeaf = False
-                            break
-                    try:
-                        # Removes the first song from the queue
-                        # Will fail if clear command is passed, not a problem though
-                        if self.leaf.branch is not None:
-                            if self.skipBranch: 
-                                del self.queue.audio[0]
-                                self.skipBranch = False
-                            else:
-                                self.queue.delete_leaf(0, 0)
-
-                        else:
-                            self.queue.delete_leaf(0)
-                    except:
-                        pass
-                    finally:
-                        self.leaf = None
-                else:
-                    time.sleep(0.5)
+                with self.queue.changed:
+                    self.queue.changed.wait_for(self.queue.current_leaf)
+                    self.leaf = self.queue.current_leaf()
+                try:
+                    self.play_leaf()
+                finally:
+                    self.queue.finish_leaf(self.leaf, self.skipBranch)
+                    self.skipBranch = False
+                    self.leaf = None
             except Exception as e:
                 print(e)
-            except KeyboardInterrupt:
-                if self.config_username:
-                    deletepid()
-                sys.exit('Exiting!')
 
+    def play_leaf(self):
+        """Feeds the current leaf to the sound output one Opus frame at a time,
+        keeping AUDIO_LEAD seconds queued, until it is over or skipped. Starts
+        mixing in the next leaf once the current one is within the crossfade.
+        """
+        sound_output = self.client.sound_output
+        playing = False  # Frames were sent since the start or the last pause
+        starved = False
+        started = False
+        self.clock.reset()
+        while True:
+            if self.skipLeaf:
+                self.skipLeaf = False
+                break
+            if self.paused:
+                with self.queue.changed:
+                    while self.paused and not self.skipLeaf:
+                        self.queue.changed.wait()
+                self.clock.reset()
+                playing = False
+                continue
+            buffered = sound_output.get_buffer_size()
+            self.buffer_level.observe(buffered, bot=self.user)
+            if playing and buffered == 0 and not starved:
+                self.clock.underruns += 1
+                starved = True
+            while buffered < AUDIO_LEAD:
+                position = self.leaf.get_position()
+                frame = self.leaf.read_frame(FRAME_SIZE, timeout=0)
+                if frame is None:  # Streamed leaf waiting on its decoder
+                    break
+                if not frame:
+                    self.leaf.stop()
+                    return
+                if self.volume != self.dsp.target:
+                    self.dsp.set_volume(self.volume)
+                remaining = self.leaf.get_remaining()
+                # Frames left untouched by the DSP, at their leaf's settled gain, are sent already encoded
+                packet = None
+                if self.dsp.transparent(position, remaining) and \
+                        self.leaf.gain == self.dsp.loudness_gain(self.leaf.loudness):
+                    packet = self.leaf.get_opus_frame(position)
+                if packet is not None and opus.install(sound_output) is not None:
+                    opus.send(sound_output, packet, frame, self.leaf.gain)
+                else:
+                    self.dsp.start()
+                    self.dsp.add(frame, position, remaining, *self.dsp.leaf_gain(self.leaf))
+                    if self.dsp.crossfade and remaining is not None and remaining <= self.dsp.crossfade:
+                        self.mix_next_leaf()
+                    sound_output.add_sound(self.dsp.finish())
+                buffered += FRAME_LENGTH
+                playing = True
+                starved = False
+                if not started:
+                    self.first_audio.observe(time.monotonic() - self.leaf.created, bot=self.user)
+                    started = True
+            self.clock.sleep(self.queue.changed)
+        self.leaf.stop()
+
+    def mix_next_leaf(self):
+        """Mixes the start of the leaf after the current one into the frame"""
+        leaf = self.queue.next_leaf()
+        if leaf is None:
+            return
+        position = leaf.get_position()
+        frame = leaf.read_frame(FRAME_SIZE, timeout=0)
+        if frame:
+            self.dsp.add(frame, position, leaf.get_remaining(), *self.dsp.leaf_gain(leaf))
 
-class FfmpegThread(threading.Thread):
+
+class AudioClock:
+    """Paces the audio loop on the Opus frame cadence with a monotonic clock,
+    and keeps count of how late it wakes up and of sound output underruns
+    """
+    def __init__(self, period):
+        self.period = period
+        self.deadline = time.monotonic()
+        self.ticks = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+        self.underruns = 0
+
+    def reset(self):
+        self.deadline = time.monotonic() + self.period
+
+    def sleep(self, condition):
+        """Sleeps until the next frame is due, or until condition is notified in
+        which case the deadline is kept for the next call
+        """
+        with condition:
+            delay = self.deadline - time.monotonic()
+            if delay > 0 and condition.wait(delay):
+                return
+        now = time.monotonic()
+        late = now - self.deadline
+        self.ticks += 1
+        self.jitter_total += late
+        self.jitter_max = max(self.jitter_max, late)
+        self.deadline += self.period
+        if late > self.period:  # Fell behind, resync instead of bursting
+            self.deadline = now + self.period
+
+    def jitter_mean(self):
+        return self.jitter_total / self.ticks if self.ticks else 0.0
+
+
+class DecoderPool:
+    """Runs several FfmpegThreads on the ffmpeg queues of the supervisor's
+    bots at the same time, taking from each bot in turn. Leaves are moved to
+    their bot's audio queue in the order they were requested, whichever
+    worker gets them ready first. A streamed leaf holds its worker until it
+    is decoded to the end, so a bot only gets as many workers as it needs to
+    play and decode the next leaf, and no more than its share of them.
+    """
     def __init__(self, parent):
+        self.parent = parent
+        self.lock = threading.Lock()
+        try:
+            size = max(int(self.parent.config['ffmpeg']['workers']), 1)
+        except (KeyError, ValueError):
+            size = 1
+        try:
+            if self.parent.config['ffmpeg']['streaming']:
+                self.buffer_size = int(float(self.parent.config['ffmpeg']['buffer_seconds']) *
+                                       handles.BYTES_PER_SECOND)
+            else:
+                self.buffer_size = None
+        except (KeyError, ValueError):
+            self.buffer_size = None
+        self.workers = [FfmpegThread(self.parent, self, i + 1) for i in range(size)]
+        self.restarts = collections.deque()  # Bots and their playing leaves to decode again after a seek
+        self.turn = 0  # Index of the bot whose queue is looked at first
+        self.active = collections.Counter()  # Bot to the leaves workers are decoding for it
+        self.pending = threading.Event()  # Set when a leaf may be waiting for a worker
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def fit(self, bots):
+        """Adds workers when streaming until each of bots can hold
+        STREAMS_PER_BOT of them, a bot without one plays nothing until
+        another bot's leaf is decoded to the end
+        """
+        if self.buffer_size is None:
+            return
+        with self.lock:
+            size = len(self.workers)
+            if size >= bots * STREAMS_PER_BOT:
+                return
+            added = [FfmpegThread(self.parent, self, i + 1) for i in range(size, bots * STREAMS_PER_BOT)]
+            self.workers.extend(added)
+        print('Raised ffmpeg workers from {0} to {1} for {2} streaming bots'.format(size, len(self.workers), bots))
+        for worker in added:
+            worker.start()
+
+    def claim(self, worker):
+        """Returns a leaf to decode again after a seek, or else the first leaf
+        of a bot's ffmpeg queue no worker has taken yet, with its bot. Returns
+        None, None if there is none. The worker calls release once done.
+        """
+        with self.lock:
+            self.pending.clear()
+            if self.restarts:
+                bot, leaf = self.restarts.popleft()
+                leaf.worker = worker.number
+                self.active[bot] += 1
+                return bot, leaf
+            bots = list(self.parent.bots)
+            limit = None
+            if self.buffer_size is not None and bots:
+                limit = max(min(STREAMS_PER_BOT, len(self.workers) // len(bots)), 1)
+            for i in range(len(bots)):
+                bot = bots[(self.turn + i) % len(bots)]
+                if limit is not None and self.active[bot] >= limit:
+                    continue
+                with bot.queue.lock:
+                    for leaf in bot.queue.ffmpeg:
+                        if leaf.worker is None:
+                            leaf.worker = worker.number
+                            self.active[bot] += 1
+                            self.turn = (self.turn + i + 1) % len(bots)
+                            return bot, leaf
+        return None, None
+
+    def release(self, bot):
+        """Called by the workers once they are done with a leaf of bot"""
+        with self.lock:
+            self.active[bot] -= 1
+            if not self.active[bot]:
+                del self.active[bot]
+        self.wake()
+
+    def wake(self):
+        """Tells the idle workers to look for leaves again"""
+        self.pending.set()
+
+    def wait(self):
+        """Blocks an idle worker until wake is called"""
+        self.pending.wait()
+
+    def seek(self, bot, leaf, seconds):
+        """Seeks the bot's leaf to seconds, restarting its decoding there if it
+        is streamed. Returns False if seconds is out of the leaf.
+        """
+        with self.lock:
+            if not leaf.seek(seconds):
+                return False
+            if leaf.buffer is not None and all(leaf is not x for _, x in self.restarts):
+                self.restarts.append((bot, leaf))
+        self.wake()
+        return True
+
+    def leaf_ready(self, bot, leaf):
+        """Called by the workers once a leaf can start playing"""
+        self.load_frames(bot, leaf)
+        with self.lock:
+            leaf.ready = True
+            self.flush(bot)
+
+    def leaf_decoded(self, bot, leaf):
+        """Called by the workers once a leaf is fully decoded, schedules its
+        encoding to Opus if its PCM is cached
+        """
+        opus_cache = self.parent.opus_cache
+        if opus_cache is None or leaf.frames is not None or leaf.stopped:
+            return
+        bitrate = opus.install(bot.client.sound_output)
+        key = cache_key(leaf)
+        if bitrate is not None and key is not None and key in self.parent.pcm_cache:
+            self.parent.opus_encoder.add(key, bitrate, bot.dsp.loudness_gain(leaf.loudness))
+
+    def load_frames(self, bot, leaf):
+        """Gives a fully decoded leaf its Opus frames, if they are cached at the
+        bitrate of the bot's sound output and with the leaf's normalization
+        gain
+        """
+        opus_cache = self.parent.opus_cache
+        if opus_cache is None or leaf.pcm is None:
+            return
+        bitrate = opus.install(bot.client.sound_output)
+        key = cache_key(leaf)
+        if bitrate is not None and key is not None:
+            gain = bot.dsp.loudness_gain(leaf.loudness)
+            leaf.frames = opus_cache.load(opus.frames_key(key, bitrate, gain))
+            if leaf.frames is not None:
+                leaf.gain = gain
+
+    def leaf_failed(self, bot, leaf):
+        with self.lock:
+            leaf.failed = True
+            self.flush(bot)
+
+    def flush(self, bot):
+        """Moves the leaves at the front of the bot's ffmpeg queue to its audio
+        queue as long as they are done, keeping the order they were added in
+        """
+        queue = bot.queue
+        with queue.lock:
+            while queue.ffmpeg:
+                leaf = queue.ffmpeg[0]
+                if leaf.ready and not leaf.stopped:
+                    queue.append_leaf(leaf)
+                elif leaf.ready or leaf.failed or leaf.stopped:
+                    queue.remove_audio(leaf)
+                else:
+                    return
+
+
+class ProbeThread(threading.Thread):
+    """Probes the leaves of the ffmpeg queue in order, ahead of the decoders,
+    for their length and tags
+    """
+    def __init__(self, parent, prober):
         threading.Thread.__init__(self)
         self.parent = parent
+        self.prober = prober
         self.daemon = True
 
+    def next_leaf(self):
+        for leaf in self.parent.queue.ffmpeg:
+            if not leaf.probed:
+                return leaf
+        return None
+
     def run(self):
+        queue = self.parent.queue
         while True:
-            if self.parent.queue.ffmpeg:
-                try:
-                    leaf = self.parent.queue.ffmpeg[0].leaves[0]
-                except AttributeError:
-                    leaf = self.parent.queue.ffmpeg[0]
-                try:
-                    process(leaf)
-                    self.parent.queue.append_leaf(leaf)
-                except AssertionError:
-                    self.parent.send_msg_current_channel(u'Could not process <b>{0}</b>'.format(leaf.title))
-                finally:
-                    self.parent.queue.remove_audio()
-            else:
-                time.sleep(0.5)
+            with queue.changed:
+                queue.changed.wait_for(self.next_leaf)
+                leaf = self.next_leaf()
+                leaf.probed = True
+            info = self.prober.probe(leaf)
+            if info is not None:
+                leaf.set_info(info)
 
 
-def process(leaf):
-    """ Converts and splits the song into the suitable format to stream to
-    mumble server (mono PCM 16 bit little-endian), using ffmpeg
+class FfmpegThread(threading.Thread):
+    def __init__(self, parent, pool, number):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.pool = pool
+        self.number = number
+        self.daemon = True
+
+    def run(self):
+        metrics = self.parent.metrics
+        decode_time = metrics.histogram('mj_decode_seconds', 'Time taken to decode leaves, streamed ones are paced '
+                                                             'by playback')
+        ready_time = metrics.histogram('mj_decode_ready_seconds', 'Time from a worker taking a leaf to it being playable')
+        failures = metrics.counter('mj_decode_failures_total', 'Leaves that could not be decoded')
+        failures.inc(0)
+        while True:
+            bot, leaf = self.pool.claim(self)
+            if leaf is None:
+                self.pool.wait()
+                continue
+            start = time.monotonic()
+
+            def ready(leaf):
+                leaf.ready_seconds = time.monotonic() - start
+                ready_time.observe(leaf.ready_seconds)
+                self.pool.leaf_ready(bot, leaf)
+
+            try:
+                process(leaf, ready, self.pool.buffer_size, self.parent.pcm_cache, self.parent.loudness)
+                decode_time.observe(time.monotonic() - start, streamed=str(leaf.buffer is not None).lower())
+                self.pool.leaf_decoded(bot, leaf)
+            except Exception as e:
+                # ffmpeg or a source missing, the caches failing to write: the leaf fails, not the worker
+                if not isinstance(e, AssertionError):
+                    traceback.print_exc()
+                failures.inc()
+                if not leaf.stopped:
+                    bot.send_msg_current_channel(u'Could not process <b>{0}</b>'.format(leaf.title))
+                self.pool.leaf_failed(bot, leaf)
+            finally:
+                self.pool.release(bot)
+
+
+def feed_stdin(pipe, data):
+    try:
+        pipe.write(data)
+        pipe.close()
+    except (BrokenPipeError, ValueError):
+        pass  # ffmpeg was stopped before reading everything
+
+
+def feed_source(pipe, source):
+    """Writes the chunks of bytes given by a source callable to ffmpeg's stdin
+    as they arrive
     """
-    command = ['ffmpeg', '-nostdin', '-i', '-', '-f', 's16le', '-acodec',
-               'pcm_s16le', '-ac', '1', '-ar', '48000', '-']
-    if leaf.pipe:
+    chunks = source()
+    try:
+        for chunk in chunks:
+            pipe.write(chunk)
+        pipe.close()
+    except (BrokenPipeError, ValueError):
+        pass  # ffmpeg was stopped before reading everything
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def read_stderr(pipe, leaf, output, measuring=False):
+    """Collects ffmpeg's stderr, setting the leaf's duration as soon as ffmpeg
+    prints the input's header and its decoding progress as it goes. If the
+    ebur128 filter is measuring the leaf, its loudness is the integrated
+    loudness so far once MIN_LOUDNESS_SECONDS were measured, and the one of
+    the summary at the end. The lines of its frame log are not collected.
+    """
+    header = True  # Until the input's header has passed
+    tail = b''  # End of the previous chunk, for a duration split between two
+    pending = b''  # Incomplete last line, while measuring
+    while True:
+        data = pipe.read1(4096)
+        if not data:
+            output.append(pending)
+            if measuring:
+                loudness = parse_loudness(b''.join(output))
+                if loudness is not None:
+                    leaf.loudness = loudness
+            return
+        if measuring:
+            lines = pending + data
+            end = lines.rfind(b'\n') + 1
+            pending = lines[end:]
+            lines = lines[:end]
+            for match in LOUDNESS_FRAME.finditer(lines):
+                if float(match.group(1)) >= MIN_LOUDNESS_SECONDS:
+                    leaf.loudness = float(match.group(2))
+            output.append(LOUDNESS_FRAME.sub(b'', lines))
+        else:
+            output.append(data)
+        if header and leaf.duration is None:
+            window = tail + data
+            start = window.find(b'Duration: ')
+            if start != -1 and window.find(b',', start) != -1 and \
+                    window[start + 10:start + 12].isdigit():
+                leaf.duration = handles.duration2sec(window[start + 10:start + 21])
+            header = b'Output #0' not in window and b'time=' not in window
+            tail = window[-HEADER_TAIL:]
+        start = data.rfind(b'time=')
+        if start != -1 and len(data) >= start + 16 and data[start + 5:start + 7].isdigit():
+            leaf.progress = handles.duration2sec(data[start + 5:start + 16])
+
+
+def parse_loudness(stderr):
+    """Returns the integrated loudness in the summary of ffmpeg's ebur128
+    filter, or None if it is not there
+    """
+    match = re.search(rb'Integrated loudness:\s+I:\s+(-?[0-9.]+) LUFS', stderr)
+    return float(match.group(1)) if match else None
+
+
+def measure_loudness(path):
+    """Runs the ebur128 filter on a file of the PCM cache, for tracks cached
+    before their loudness was known
+    """
+    command = ['ffmpeg', '-nostdin', '-f', 's16le', '-ar', '48000', '-ac', '1', '-i', path,
+               '-af', 'ebur128', '-f', 'null', '-']
+    try:
+        p = sp.run(command, stdout=sp.DEVNULL, stderr=sp.PIPE)
+    except OSError:
+        return None
+    return parse_loudness(p.stderr)
+
+
+def drain(pipe, output):
+    """Collects the stderr of a source command so it never blocks on it"""
+    for line in pipe:
+        output.append(line)
+
+
+def start_ffmpeg(leaf, command):
+    """Starts ffmpeg on the leaf's file, on its bytes if it is piped, or on the
+    output of its source command, which is connected straight to ffmpeg's
+    stdin. A callable source is called for an iterable of bytes fed to
+    ffmpeg. Returns the processes, ffmpeg last, ffmpeg's stderr as it is
+    collected and the threads collecting stderr.
+    """
+    processes = []
+    threads = []
+    if callable(leaf.source):
+        p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
+        threading.Thread(target=feed_source, args=(p.stdin, leaf.source), daemon=True).start()
+    elif leaf.source is not None:
+        source = sp.Popen(leaf.source, stdout=sp.PIPE, stderr=sp.PIPE)
+        p = sp.Popen(command, stdin=source.stdout, stdout=sp.PIPE, stderr=sp.PIPE)
+        source.stdout.close()  # Only ffmpeg reads it, the source gets SIGPIPE if ffmpeg stops
+        source.output = []
+        threads.append(threading.Thread(target=drain, args=(source.stderr, source.output), daemon=True))
+        processes.append(source)
+    elif leaf.pipe:
         p = sp.Popen(command, stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.PIPE)
-        stdout, stderr = p.communicate(input=leaf.file)
+        threading.Thread(target=feed_stdin, args=(p.stdin, leaf.file), daemon=True).start()
     else:
-        command[3] = leaf.file
+        command[command.index('-i') + 1] = leaf.file
         p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-        stdout, stderr = p.communicate()
-    print(stderr)
-    assert len(stdout) > 0
-    counter = 1
-    start = stderr.rfind(b'time=')
-    leaf.duration = stderr[start + 5:start + 17]
-    with io.BytesIO(stdout) as out:
-        while True:
-            leaf.samples[counter] = out.read(88200)
-            if not leaf.samples[counter]:  # If last fragment is empty
-                leaf.total_samples = counter
-                return
-            counter += 1
+    processes.append(p)
+    output = []
+    measuring = any(arg.startswith('ebur128') for arg in command)
+    threads.append(threading.Thread(target=read_stderr, args=(p.stderr, leaf, output, measuring), daemon=True))
+    for thread in threads:
+        thread.start()
+    return processes, output, threads
+
+
+def stop_ffmpeg(processes, threads, timeout=0):
+    """Waits for the processes of start_ffmpeg, killing those still running
+    after timeout seconds. Their output was read to the end unless the leaf
+    was aborted, the timeout lets ffmpeg print its summary (the loudness
+    measured by ebur128) before it exits.
+    """
+    for p in reversed(processes):
+        try:
+            p.wait(timeout)
+        except sp.TimeoutExpired:
+            p.kill()
+            p.wait()
+    for thread in threads:
+        thread.join()
+    for p in processes[:-1]:
+        print(b''.join(p.output))
+
+
+def process(leaf, ready=None, buffer_size=None, cache=None, loudness=None):
+    """ Converts and splits the song into the suitable format to stream to
+    mumble server (mono PCM 16 bit little-endian), using ffmpeg. Calls ready
+    with the leaf once it can be played. If buffer_size is given, the leaf is
+    streamed: ready is called as soon as the first chunk is decoded and the
+    decoding waits on playback so at most buffer_size bytes are held in memory.
+    With a PCMCache, cached audio is mapped into the leaf without running
+    ffmpeg, and what ffmpeg decodes is added to the cache. With a
+    LoudnessStore, the loudness of tracks it does not know is measured while
+    they are decoded.
+    """
+    command = ['ffmpeg', '-nostdin', '-i', '-', '-f', 's16le', '-acodec',
+               'pcm_s16le', '-ac', '1', '-ar', '48000', '-']
+    if leaf.buffer is not None:  # Decoding again from where it was seeked to
+        stream(leaf, command, None, buffer_size)
+        return
+    key = cache_key(leaf) if cache is not None or loudness is not None else None
+    if loudness is not None:
+        leaf.loudness = loudness.get(key)
+        if leaf.loudness is None:
+            command[-1:-1] = ['-af', 'ebur128=framelog=info']
+    if cache is not None and key is not None:
+        pcm = cache.open(key)
+        if pcm is not None:
+            leaf.set_pcm(pcm)
+            if ready is not None:
+                ready(leaf)
+            if loudness is not None and leaf.loudness is None:
+                # Ramped to if the leaf started playing in the meantime
+                leaf.loudness = measure_loudness(cache.path(key))
+                loudness.set(key, leaf.loudness)
+            return
+    writer = cache.writer(key) if cache is not None and key is not None else None
+    if buffer_size is not None:
+        stream(leaf, command, ready, buffer_size, writer)
+        if loudness is not None and leaf.total_bytes is not None:
+            loudness.set(key, leaf.loudness)
+        return
+    try:
+        processes, output, threads = start_ffmpeg(leaf, command)
+        pcm = read_pcm(leaf, processes[-1].stdout)
+        stop_ffmpeg(processes, threads, EXIT_TIMEOUT)
+        print(b''.join(output))
+        assert len(pcm) > 0
+    except AssertionError:
+        if writer is not None:
+            writer.discard()
+        raise
+    if writer is not None:
+        writer.write(pcm)
+        writer.commit()
+    if loudness is not None:
+        loudness.set(key, leaf.loudness)
+    leaf.set_pcm(pcm)
+    if ready is not None:
+        ready(leaf)
+
+
+def read_pcm(leaf, stdout):
+    """Reads all of ffmpeg's output into a single bytearray, allocated from
+    the duration in ffmpeg's header as soon as it is known
+    """
+    pcm = bytearray(handles.CHUNK_SIZE)
+    length = 0
+    while True:
+        if length == len(pcm):
+            estimate = int(leaf.duration * handles.BYTES_PER_SECOND) if leaf.duration else 0
+            pcm.extend(bytes(max(estimate + handles.CHUNK_SIZE - length, length)))
+        with memoryview(pcm) as view:
+            n = stdout.readinto(view[length:])
+        if not n:
+            break
+        length += n
+    del pcm[length:]
+    return pcm
+
+
+def stream(leaf, command, ready, buffer_size, writer=None):
+    """Streaming counterpart of process, reads ffmpeg's output chunk by chunk
+    into the leaf's RingBuffer, and into writer if given. A leaf that already
+    has a buffer was seeked, its decoding starts again at the leaf's offset.
+    """
+    if leaf.buffer is None:
+        frames = max(buffer_size, 2 * handles.CHUNK_SIZE) // handles.FRAME_SIZE + 1
+        leaf.buffer = handles.RingBuffer(frames * handles.FRAME_SIZE)
+    # Read in this order, a seek replaces the offset before the buffer
+    buffer = leaf.buffer
+    offset = leaf.offset
+    if leaf.stopped:
+        buffer.abort()
+    if buffer.aborted:  # Stopped or seeked again before the decoder started
+        if writer is not None:
+            writer.discard()
+        return
+    if offset:
+        seconds = offset // handles.SAMPLE_WIDTH / float(handles.SAMPLE_RATE)
+        command = command[:2] + ['-ss', '{0:.3f}'.format(seconds)] + command[2:]
+    processes, output, threads = start_ffmpeg(leaf, command)
+    p = processes[-1]
+    timeout = 0  # Kills ffmpeg at once unless its output was read to the end
+    try:
+        chunk = p.stdout.read(handles.CHUNK_SIZE)
+        assert len(chunk) > 0 or offset  # Seeked right to the end otherwise
+        buffer.write(chunk)
+        if writer is not None:
+            writer.write(chunk)
+        if ready is not None:
+            ready(leaf)
+        while chunk:
+            chunk = p.stdout.read(handles.CHUNK_SIZE)
+            if not buffer.write(chunk):
+                break
+            if writer is not None:
+                writer.write(chunk)
+        else:
+            leaf.total_bytes = offset + buffer.written
+            leaf.duration = leaf.total_bytes // handles.SAMPLE_WIDTH / float(handles.SAMPLE_RATE)
+            timeout = EXIT_TIMEOUT
+            if writer is not None:
+                writer.commit()
+                writer = None
+    finally:
+        stop_ffmpeg(processes, threads, timeout)
+        buffer.close()
+        if writer is not None:
+            writer.discard()
+    print(b''.join(output))
 
 
 class LoopThread(threading.Thread):
@@ -346,64 +1029,208 @@ class LoopThread(threading.Thread):
         while True:
             time.sleep(1)
             counter += 1
-            for module in self.parent.registered_modules:
-                if hasattr(module, 'loop') and hasattr(module.loop, 'time'):
-                    if counter % module.loop.time == 0:
-                        module.loop(self.parent)
+            for module in list(self.parent.modules.values()):
+                loop = getattr(module.module, 'loop', None)
+                if loop is not None and hasattr(loop, 'time'):
+                    if counter % loop.time == 0:
+                        loop(self.parent)
 
 
 class Queues:
-    def __init__(self):
-        self.ffmpeg = []
-        self.audio = []
+    """The ffmpeg queue holds leaves waiting to be processed and the audio
+    queue holds the leaves and branches ready to be played. A branch is made
+    by the producer queuing its leaves, which adds them to it directly, so
+    branches with the same title stay apart. Branches know how many of their
+    leaves are still processing, so counting a branch is O(1). Every
+    method is safe to call from any thread, changed is notified whenever the
+    queues change and added is called whenever a leaf is added to the ffmpeg
+    queue.
+    """
+    def __init__(self, added=None):
+        self.added = added
+        self.ffmpeg = collections.deque()
+        self.audio = collections.deque()
+        self.branches = set()  # Branches with leaves queued, processed or not
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+
+    def notify(self):
+        with self.changed:
+            self.changed.notify_all()
 
     def __iter__(self):
-        for i in self.audio:
+        audio, ffmpeg = self.snapshot()
+        for i in audio:
             yield i
-        for j in self.ffmpeg:
+        for j in ffmpeg:
             yield j
 
-    def append_audio(self, audio_file, audio_title, branchname=None, pipe=False):
+    def snapshot(self):
+        """Returns copies of the audio and ffmpeg queues"""
+        with self.lock:
+            return list(self.audio), list(self.ffmpeg)
+
+    def append_audio(self, audio_file, audio_title, branch=None, pipe=False, cache_key=None, source=None):
+        """Adds audio to be processed, to the handles.Branch branch if given.
+        audio_file is a path or URL for ffmpeg, or the audio's bytes if pipe
+        is True. If source is given, it is a command whose output is piped
+        into ffmpeg, or a callable returning an iterable of the audio's
+        bytes, called again whenever the decoding restarts, and audio_file
+        only names it. A leaf added to a dropped branch is stopped and not
+        queued.
+        """
         leaf = handles.Leaf(audio_file, audio_title, pipe)
-        if branchname is not None:
-            branch = handles.Branch(branchname, leaf)
-            self.ffmpeg.append(branch)
-        else:
+        leaf.cache_key = cache_key
+        leaf.source = source
+        with self.lock:
+            if branch is not None:
+                leaf.branch = branch
+                if branch.dropped:  # Skipped or cleared before its producer noticed
+                    leaf.stop()
+                    return leaf
+                branch.pending += 1
+                self.branches.add(branch)
             self.ffmpeg.append(leaf)
+            self.changed.notify_all()
+        if self.added is not None:
+            self.added()
+        return leaf
 
-    def remove_audio(self):
-        del self.ffmpeg[0]
+    def remove_audio(self, leaf=None):
+        """Removes leaf, or the first one, from the ffmpeg queue if it is still
+        there, when it will not be played
+        """
+        with self.lock:
+            if leaf is None:
+                leaf = self.ffmpeg[0]
+            if self.ffmpeg and self.ffmpeg[0] is leaf:
+                self.ffmpeg.popleft()
+            elif leaf in self.ffmpeg:
+                self.ffmpeg.remove(leaf)
+            else:
+                return
+            if leaf.branch is not None:
+                leaf.branch.pending -= 1
+                self.release_branch(leaf.branch)
+            self.changed.notify_all()
 
     def append_leaf(self, leaf):
-        if leaf.branch is None:
-            self.audio.append(leaf)
-        else:
-            for i in self.audio:
-                if i.title == leaf.branch.title and isinstance(i, handles.Branch):
-                    i.append(leaf)
-                    return
-            self.audio.append(leaf.branch)
+        """Moves a processed leaf from the ffmpeg queue to the audio queue"""
+        with self.lock:
+            if self.ffmpeg and self.ffmpeg[0] is leaf:
+                self.ffmpeg.popleft()
+            elif leaf in self.ffmpeg:
+                self.ffmpeg.remove(leaf)
+            else:
+                return  # Cleared or skipped in the meantime
+            if leaf.branch is None:
+                self.audio.append(leaf)
+            else:
+                branch = leaf.branch
+                branch.pending -= 1
+                branch.append(leaf)
+                if not branch.queued:
+                    branch.queued = True
+                    self.audio.append(branch)
+            self.changed.notify_all()
+
+    def current_leaf(self):
+        """Returns the leaf at the front of the audio queue, or None"""
+        with self.lock:
+            if not self.audio:
+                return None
+            return handles.first_leaf(self.audio[0])
+
+    def next_leaf(self):
+        """Returns the leaf that will play after the current one, if it is
+        already in the audio queue
+        """
+        with self.lock:
+            if not self.audio:
+                return None
+            if isinstance(self.audio[0], handles.Branch) and len(self.audio[0]) > 1:
+                return self.audio[0].leaves[1]
+            if len(self.audio) > 1:
+                return handles.first_leaf(self.audio[1])
+            return None
+
+    def finish_leaf(self, leaf, skip_branch=False):
+        """Removes a leaf that is done playing from the audio queue, along with
+        the rest of its branch if skip_branch
+        """
+        with self.lock:
+            branch = leaf.branch
+            if branch is None:
+                if leaf in self.audio:
+                    self.audio.remove(leaf)
+            elif skip_branch:
+                self.drop_branch(branch)
+            elif leaf in branch:
+                branch.remove(leaf)
+                self.release_branch(branch)
+            self.changed.notify_all()
 
     def delete_leaf(self, leaf_index, branch_index=None):
-        if branch_index is None:
-            del self.audio[leaf_index]
-        else:
-            self.audio[branch_index].remove_leaf(leaf_index)
-            if not self.audio[branch_index]:
-                self.delete_branch(branch_index)
+        with self.lock:
+            if branch_index is None:
+                self.audio[leaf_index].stop()
+                del self.audio[leaf_index]
+            else:
+                branch = self.audio[branch_index]
+                branch.leaves[leaf_index].stop()
+                branch.remove_leaf(leaf_index)
+                self.release_branch(branch)
+            self.changed.notify_all()
 
     def delete_branch(self, branch_index):
-        del self.audio[branch_index]
+        with self.lock:
+            self.drop_branch(self.audio[branch_index])
+            self.changed.notify_all()
+
+    def drop_branch(self, branch):
+        """Stops every leaf of the branch, processed or not, and tells its
+        producer to stop adding to it
+        """
+        for leaf in branch:
+            leaf.stop()
+        for leaf in [leaf for leaf in self.ffmpeg if leaf.branch is branch]:
+            leaf.stop()
+            self.ffmpeg.remove(leaf)
+        branch.pending = 0
+        branch.leaves.clear()
+        branch.dropped = True
+        self.release_branch(branch)
+
+    def release_branch(self, branch):
+        """Takes an empty branch off the audio queue, and out of the branches
+        once none of its leaves are left to process
+        """
+        if not branch and branch.queued:
+            branch.queued = False
+            self.audio.remove(branch)
+        if not branch.count():
+            self.branches.discard(branch)
+
+    def branch_count(self, branch):
+        """Number of leaves of the branch still queued, processed or not"""
+        with self.lock:
+            return branch.count()
+
+    def wait_for_room(self, branch, size, timeout=None):
+        """Waits until less than size leaves of the branch are queued. Returns
+        False on timeout or if the branch was skipped or cleared in the meantime.
+        """
+        with self.changed:
+            return self.changed.wait_for(lambda: branch.dropped or branch.count() < size, timeout) \
+                and not branch.dropped
 
     def build_mirror(self):
         mirror = {}
         for i in self:
             if isinstance(i, handles.Branch):
-                try:
-                    for leaf in i:
-                        mirror[i.title].append(leaf.title)
-                except KeyError:
-                    mirror[i.title] = [leaf.title for leaf in i]
+                mirror.setdefault(i.title, []).extend(leaf.title for leaf in i)
+            elif i.branch is not None:
+                mirror.setdefault(i.branch.title, []).append(i.title)
             else:
                 try:
                     mirror[i.title] += 1
@@ -412,10 +1239,28 @@ class Queues:
         return mirror
 
     def clear(self):
-        # TODO fix cause it keeps failing with current ffmpeg thread
-        self.ffmpeg = []
-        self.audio = []
+        with self.lock:
+            for branch in list(self.branches):
+                self.drop_branch(branch)
+            for i in list(self.audio) + list(self.ffmpeg):
+                for leaf in (i if isinstance(i, handles.Branch) else [i]):
+                    leaf.stop()
+            self.ffmpeg.clear()
+            self.audio.clear()
+            self.branches.clear()
+            self.changed.notify_all()
 
 
 if __name__ == '__main__':
-    bot = MumbleJumble()
+    with open(os.path.join(SCRIPTPATH, 'config.json')) as json_config_file:
+        config = json.load(json_config_file)
+    parameters, users = parse_arguments(config)
+    supervisor = Supervisor(config)
+    for user in users:
+        try:
+            supervisor.start_bot(user, parameters)
+        except ConnectionError as e:
+            print(e)
+    if not supervisor.bots:
+        sys.exit('Could not connect to server, are you sure it is set properly?')
+    supervisor.run()
@@ -0,0 +1,82 @@
+"""Replays a scripted stream of chat messages from several users through
+FakeMumble's text callback, as pymumble's thread would deliver them, and
+measures how long the callback holds that thread and how long the commands
+take on the executor
+"""
+import os
+import time
+
+from environment import BENCHPATH, percentile, write_wav
+
+SCRIPT = os.path.join(BENCHPATH, 'scripts', 'basic.txt')
+
+
+def read_script(path):
+    """Returns the (delay in seconds, user, message) of each line of a script"""
+    lines = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            delay, user, message = line.split(' ', 2)
+            lines.append((int(delay) / 1000.0, user, message))
+    return lines
+
+
+def replay(client, lines, sessions):
+    """Sends the lines of a script, returns the time each callback took"""
+    callbacks = []
+    for delay, user, message in lines:
+        time.sleep(delay)
+        start = time.perf_counter()
+        client.send_text(sessions[user], message)
+        callbacks.append(time.perf_counter() - start)
+    return callbacks
+
+
+def wait_idle(executor, timeout):
+    deadline = time.monotonic() + timeout
+    while executor.pending or executor.running:
+        if time.monotonic() > deadline:
+            raise RuntimeError('Commands still running after {0} s'.format(timeout))
+        time.sleep(0.01)
+
+
+def run(env, quick=False):
+    album = os.path.join(env.config['localplay']['local_folder'], 'album')
+    if not os.path.isdir(album):
+        os.makedirs(album)
+        for i in range(5):
+            write_wav(os.path.join(album, 'tone {0}.wav'.format(i)), 3, 220.0 * (i + 1))
+    bot = env.start(1)[0]
+    client = bot.client
+    executor = env.supervisor.commands
+    lines = read_script(SCRIPT)
+    sessions = {user: client.users.add(user) for user in sorted(set(user for _, user, _ in lines))}
+    rounds = 1 if quick else 5
+
+    counters = ('completed', 'failed', 'rejected', 'limited', 'run_time')
+    before = {name: getattr(executor, name) for name in counters}
+    messages = len(client.messages())
+    callbacks = []
+    start = time.perf_counter()
+    for i in range(rounds):
+        callbacks += replay(client, lines, sessions)
+        wait_idle(executor, 120)
+    elapsed = time.perf_counter() - start
+    done = {name: getattr(executor, name) - before[name] for name in counters}
+
+    finished = done['completed'] + done['failed']
+    latency = env.supervisor.metrics.histogram('mj_command_seconds', 'Time commands took to run, by command')
+    return {'messages_sent': len(callbacks),
+            'replay_seconds': elapsed,
+            'callback_p50_seconds': percentile(callbacks, 0.5),
+            'callback_p95_seconds': percentile(callbacks, 0.95),
+            'callback_max_seconds': max(callbacks),
+            'commands_completed': done['completed'],
+            'commands_failed': done['failed'],
+            'commands_dropped': done['rejected'] + done['limited'],
+            'command_mean_seconds': done['run_time'] / finished if finished else 0.0,
+            'command_p95_bucket_seconds': latency.quantile(0.95),
+            'replies': len(client.messages()) - messages}
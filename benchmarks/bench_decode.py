@@ -0,0 +1,69 @@
+"""Throughput of process() on generated audio: whole, streamed through a
+RingBuffer drained as fast as it fills, and several leaves decoded at once
+"""
+import threading
+import time
+
+import handles
+import MumbleJumble
+
+DRAIN_SIZE = 50 * handles.FRAME_SIZE
+
+
+def decode(path, buffer_size=None):
+    """Decodes a file into a leaf, draining it if streamed. Returns the leaf
+    and the seconds until it was ready to play.
+    """
+    leaf = handles.Leaf(path, 'tone', False)
+    start = time.perf_counter()
+    ready = []
+    drainer = None
+
+    def on_ready(leaf):
+        ready.append(time.perf_counter() - start)
+
+    if buffer_size is None:
+        MumbleJumble.process(leaf, on_ready)
+    else:
+        drainer = threading.Thread(target=drain, args=(leaf,), daemon=True)
+        drainer.start()
+        MumbleJumble.process(leaf, on_ready, buffer_size)
+        drainer.join()
+    return leaf, ready[0] if ready else None
+
+
+def drain(leaf):
+    while leaf.buffer is None:
+        time.sleep(0.001)
+    while leaf.read_frame(DRAIN_SIZE):
+        pass
+
+
+def run(env, quick=False):
+    seconds = 30 if quick else 180
+    path = env.audio_file(seconds)
+    buffer_size = int(env.config['ffmpeg']['buffer_seconds'] * handles.BYTES_PER_SECOND)
+    results = {}
+
+    start = time.perf_counter()
+    leaf, ready = decode(path)
+    elapsed = time.perf_counter() - start
+    assert leaf.total_bytes == seconds * handles.BYTES_PER_SECOND, leaf.total_bytes
+    results['whole_audio_seconds_per_second'] = seconds / elapsed
+    results['whole_ready_seconds'] = ready
+
+    start = time.perf_counter()
+    leaf, ready = decode(path, buffer_size)
+    elapsed = time.perf_counter() - start
+    results['streamed_audio_seconds_per_second'] = seconds / elapsed
+    results['streamed_ready_seconds'] = ready
+
+    count = 4
+    threads = [threading.Thread(target=decode, args=(path,)) for i in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results['parallel_audio_seconds_per_second'] = count * seconds / (time.perf_counter() - start)
+    return results
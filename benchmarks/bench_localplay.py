@@ -0,0 +1,52 @@
+"""LocalPlayer.ls and the library behind it on synthetic trees: a wide folder
+of thousands of files and a nested one, indexed cold and again unchanged
+"""
+import os
+import types
+
+import loader
+from environment import REPOPATH, make_tree, timed
+
+
+def local_player(root, index):
+    """Returns a LocalPlayer of its own module, with a library no bot's
+    indexer touches
+    """
+    LocalPlay = loader.import_file('LocalPlay', os.path.join(REPOPATH, 'modules', 'LocalPlay.py'))
+    messages = []
+    parent = types.SimpleNamespace(config={'localplay': {'local_folder': root, 'index': index}},
+                                   shared=lambda name, factory: factory(),
+                                   send_msg_current_channel=messages.append, messages=messages)
+    return LocalPlay.LocalPlayer(parent)
+
+
+def run(env, quick=False):
+    root = os.path.join(env.folder, 'trees')
+    wide = 1000 if quick else 5000
+    nested = 8 if quick else 20
+    os.makedirs(os.path.join(root, 'wide'))
+    os.makedirs(os.path.join(root, 'nested'))
+    files = make_tree(os.path.join(root, 'wide'), 0, wide, 0)
+    files += make_tree(os.path.join(root, 'nested'), nested, 10, 2)
+    player = local_player(root, os.path.join(env.folder, 'trees.db'))
+    library = player.library
+    results = {'files': files}
+
+    results['update_cold_seconds'] = timed(library.update)
+    assert len(library) == files, len(library)
+    results['update_warm_seconds'] = timed(library.update, 3)
+
+    player.working_dir = 'wide'
+    results['ls_wide_seconds'] = timed(player.ls, 5)
+    results['ls_wide_messages'] = len(player.ls())
+    player.working_dir = '.'
+    results['ls_root_seconds'] = timed(player.ls, 5)
+    player.working_dir = 'nested/folder 000'
+    results['ls_nested_seconds'] = timed(player.ls, 5)
+
+    results['expand_folder_seconds'] = timed(lambda: player.expand('/nested'), 3)
+    results['glob_seconds'] = timed(lambda: library.glob('nested/*/track 000*'), 3)
+    results['search_seconds'] = timed(lambda: library.search('track 0004 artist 4', 20), 3)
+    results['search_fuzzy_seconds'] = timed(lambda: library.search('trk4rtst', 20), 3)
+    library.db.close()
+    return results
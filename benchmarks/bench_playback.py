@@ -0,0 +1,58 @@
+"""Frame pacing of audio_loop: plays generated audio through a bot connected
+to FakeMumble and measures the intervals between the frames it adds to the
+sound output, the AudioClock's lateness, underruns and the CPU it used
+"""
+import statistics
+import time
+
+import handles
+from environment import percentile
+
+SKIP_FRAMES = 10  # The first frames fill AUDIO_LEAD in a burst
+
+
+def wait(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise RuntimeError('Timed out after {0} s'.format(timeout))
+        time.sleep(0.01)
+
+
+def run(env, quick=False):
+    bot = env.start(1)[0]
+    sound_output = bot.client.sound_output
+    leaves = 1 if quick else 3
+    seconds = 5 if quick else 20
+    path = env.audio_file(seconds)
+    wait(lambda: bot.leaf is None and not sound_output.pcm, 10)
+    sound_output.reset()
+    bot.clock.ticks = bot.clock.underruns = 0
+    bot.clock.jitter_total = bot.clock.jitter_max = 0.0
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    for i in range(leaves):
+        bot.append_audio(path, 'tone {0}'.format(i))
+    wait(lambda: sound_output.added, 30)
+    first_audio = sound_output.added[0] - start
+    wait(lambda: not bot.queue.current_leaf() and not bot.queue.ffmpeg and not sound_output.pcm,
+         leaves * seconds * 2 + 30)
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    added = sound_output.added[SKIP_FRAMES:]
+    intervals = [b - a for a, b in zip(added, added[1:])]
+    frames = leaves * seconds * handles.BYTES_PER_SECOND // handles.FRAME_SIZE
+    return {'frames': len(sound_output.added),
+            'frames_missing': frames - len(sound_output.added),
+            'first_audio_seconds': first_audio,
+            'interval_mean_seconds': statistics.mean(intervals),
+            'interval_stdev_seconds': statistics.pstdev(intervals),
+            'interval_p99_seconds': percentile(intervals, 0.99),
+            'interval_max_seconds': max(intervals),
+            'clock_jitter_mean_seconds': bot.clock.jitter_mean(),
+            'clock_jitter_max_seconds': bot.clock.jitter_max,
+            'bot_underruns': bot.clock.underruns,
+            'output_underruns': sum(1 for t in sound_output.dry if t < sound_output.added[-1]),
+            'cpu_percent': 100 * cpu / elapsed}
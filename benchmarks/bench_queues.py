@@ -0,0 +1,62 @@
+"""Cost of the Queues operations, build_mirror and print_queue with the
+queues holding thousands of leaves, single and in branches
+"""
+import types
+
+import builtin
+import handles
+import MumbleJumble
+from environment import timed
+
+
+def fill(queue, entries, branches):
+    """Queues entries leaves, the second half of them spread over branches,
+    a list of handles.Branch, and moves them all to the audio queue. Returns
+    the leaves.
+    """
+    leaves = [queue.append_audio('/music/{0}.mp3'.format(i), 'song {0}'.format(i)) for i in range(entries // 2)]
+    leaves += [queue.append_audio('/music/{0}.mp3'.format(i), 'song {0}'.format(i),
+                                  branches[i % len(branches)]) for i in range(entries // 2, entries)]
+    for leaf in leaves:
+        leaf.duration = 180.0
+        leaf.ready = True
+    return leaves
+
+
+def run(env, quick=False):
+    entries = 2000 if quick else 10000
+    branches = [handles.Branch('folder {0}'.format(i)) for i in range(100)]
+    calls = 1000
+    results = {'entries': entries}
+
+    queue = MumbleJumble.Queues()
+    results['append_audio_seconds'] = timed(lambda: fill(queue, entries, branches)) / entries
+    leaves = list(queue.ffmpeg)
+    results['append_leaf_in_order_seconds'] = timed(lambda: [queue.append_leaf(leaf) for leaf in leaves]) / entries
+
+    bot = types.SimpleNamespace(queue=queue, paused=False, modules={}, messages=[])
+    bot.send_msg_current_channel = bot.messages.append
+    results['snapshot_seconds'] = timed(lambda: [queue.snapshot() for i in range(calls)]) / calls
+    results['current_leaf_seconds'] = timed(lambda: [queue.current_leaf() for i in range(calls)]) / calls
+    results['next_leaf_seconds'] = timed(lambda: [queue.next_leaf() for i in range(calls)]) / calls
+    results['branch_count_seconds'] = timed(
+        lambda: [queue.branch_count(branches[i % len(branches)]) for i in range(calls)]) / calls
+    results['build_mirror_seconds'] = timed(queue.build_mirror, 5)
+    results['print_queue_seconds'] = timed(lambda: builtin.print_queue(bot, 'q', ''), 5)
+    results['print_queue_bytes'] = len(bot.messages[-1])
+
+    deletes = 100
+    results['delete_leaf_seconds'] = timed(
+        lambda: [queue.delete_leaf(len(queue.audio) // 2) for i in range(deletes)]) / deletes
+    remaining = [leaf for leaf in leaves if not leaf.stopped]
+    results['finish_leaf_seconds'] = timed(lambda: [queue.finish_leaf(leaf) for leaf in remaining]) / len(remaining)
+    assert not queue.audio and not queue.branches
+
+    # Decoders finishing out of order search the ffmpeg queue for the leaf
+    queue = MumbleJumble.Queues()
+    branches = [handles.Branch('folder {0}'.format(i)) for i in range(100)]
+    leaves = fill(queue, entries, branches)
+    results['append_leaf_reversed_seconds'] = timed(
+        lambda: [queue.append_leaf(leaf) for leaf in reversed(leaves)]) / entries
+    results['clear_seconds'] = timed(queue.clear)
+    return results
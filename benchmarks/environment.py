@@ -0,0 +1,121 @@
+"""Sets up what the benchmarks run against: a config with the caches off, a
+supervisor whose bots connect to FakeMumble, generated audio files and
+synthetic folder trees
+"""
+import json
+import math
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import wave
+
+BENCHPATH = os.path.dirname(os.path.abspath(__file__))
+REPOPATH = os.path.dirname(BENCHPATH)
+sys.path.insert(0, REPOPATH)
+sys.path.insert(0, BENCHPATH)
+
+import fake_mumble
+fake_mumble.install()
+
+SAMPLE_RATE = 44100  # Not the bot's rate, so ffmpeg resamples as it would a real file
+
+
+def load_config(folder):
+    """Returns config.json changed so nothing is cached or served, nothing is
+    rate limited and the local folder is in the benchmark's folder
+    """
+    with open(os.path.join(REPOPATH, 'config.json')) as f:
+        config = json.load(f)
+    config['bot'].update({'server': 'localhost', 'quiet': False})
+    config['cache']['enabled'] = False
+    config['metrics']['enabled'] = False
+    config['ffmpeg']['probe'] = False
+    config['commands']['rate'] = 0
+    config['localplay'].update({'local_folder': os.path.join(folder, 'library'),
+                                'index': os.path.join(folder, 'localplay.db'),
+                                'rescan_interval': 3600})
+    os.makedirs(config['localplay']['local_folder'], exist_ok=True)
+    return config
+
+
+def write_wav(path, seconds, frequency=440.0, channels=2):
+    """Writes a sine wave of the given length as 16 bit PCM"""
+    frame = 2 * channels
+    with wave.open(path, 'wb') as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        period = [int(12000 * math.sin(2 * math.pi * frequency * i / SAMPLE_RATE)) for i in range(SAMPLE_RATE)]
+        second = b''.join(struct.pack('<h', x) * channels for x in period)
+        whole, part = divmod(seconds, 1)
+        for i in range(int(whole)):
+            f.writeframes(second)
+        f.writeframes(second[:int(part * SAMPLE_RATE) * frame])
+    return path
+
+
+def make_tree(root, folders, files, depth=1):
+    """Creates folders subfolders per level down to depth, each with files
+    empty audio files. Returns the number of files.
+    """
+    count = 0
+    for i in range(files):
+        open(os.path.join(root, 'track {0:04d} - artist {1}.mp3'.format(i, i % 7)), 'wb').close()
+        count += 1
+    if depth > 0:
+        for i in range(folders):
+            path = os.path.join(root, 'folder {0:03d}'.format(i))
+            os.makedirs(path, exist_ok=True)
+            count += make_tree(path, folders, files, depth - 1)
+    return count
+
+
+def percentile(values, q):
+    """Returns the q quantile of values, by nearest rank"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def timed(function, repeat=1):
+    """Returns the best time in seconds of repeat calls to function"""
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class Environment:
+    """Temporary folder and supervisor shared by the benchmarks of a run"""
+    def __init__(self):
+        self.folder = tempfile.mkdtemp(prefix='mumblejumble-bench-')
+        self.config = load_config(self.folder)
+        self.supervisor = None
+        self.audio = {}  # Seconds to the path of a generated file that long
+
+    def start(self, bots=1):
+        """Starts the supervisor and its bots, returns the bots"""
+        import MumbleJumble
+        if self.supervisor is None:
+            self.supervisor = MumbleJumble.Supervisor(self.config)
+        parameters = {key: self.config['bot'][key] for key in
+                      ('server', 'port', 'password', 'certfile', 'reconnect', 'debug', 'quiet')}
+        while len(self.supervisor.bots) < bots:
+            self.supervisor.start_bot('bench{0}'.format(len(self.supervisor.bots) + 1), parameters)
+        return self.supervisor.bots[:bots]
+
+    def audio_file(self, seconds):
+        """Returns a generated WAV file of the given length"""
+        if seconds not in self.audio:
+            path = os.path.join(self.folder, 'tone-{0}.wav'.format(seconds))
+            self.audio[seconds] = write_wav(path, seconds)
+        return self.audio[seconds]
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
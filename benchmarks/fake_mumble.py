@@ -0,0 +1,145 @@
+"""Local stand-in for pymumble.Mumble, so the bot runs without a server.
+install() must be called before MumbleJumble is imported.
+"""
+import sys
+import threading
+import time
+import types
+
+FRAME_LENGTH = 0.02
+FRAME_SIZE = 1920
+BYTES_PER_SECOND = 96000
+
+
+class FakeSoundOutput:
+    """Takes PCM like pymumble's sound output and plays it back in real time,
+    one frame every FRAME_LENGTH, recording when audio was added and when the
+    output ran dry after playing
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pcm = []
+        self.encoder = None  # No Opus encoder, pymumble's is not running
+        self.added = []  # Times of add_sound
+        self.dry = []  # Times the output ran dry
+        self.sent = 0  # Frames played
+        self.playing = False
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add_sound(self, pcm):
+        with self.lock:
+            self.pcm.append(bytes(pcm))
+            self.added.append(time.monotonic())
+
+    def get_buffer_size(self):
+        with self.lock:
+            return sum(len(x) for x in self.pcm) / float(BYTES_PER_SECOND)
+
+    def reset(self):
+        with self.lock:
+            self.added = []
+            self.dry = []
+            self.sent = 0
+            self.playing = False
+
+    def run(self):
+        tick = time.monotonic()
+        while True:
+            tick += FRAME_LENGTH
+            time.sleep(max(tick - time.monotonic(), 0))
+            with self.lock:
+                if self.pcm:
+                    self.pcm.pop(0)
+                    self.sent += 1
+                    self.playing = True
+                elif self.playing:
+                    self.dry.append(time.monotonic())
+                    self.playing = False
+
+
+class FakeUser(dict):
+    def __init__(self, session, name, channel_id=0):
+        dict.__init__(self, session=session, name=name, channel_id=channel_id)
+        self.comments = []
+
+    def unmute(self):
+        pass
+
+    def comment(self, text):
+        self.comments.append(text)
+
+
+class FakeUsers(dict):
+    def __init__(self, name):
+        dict.__init__(self)
+        self.myself = self[0] = FakeUser(0, name)
+
+    def add(self, name):
+        """Adds a user to the server, returns their session"""
+        session = len(self)
+        self[session] = FakeUser(session, name)
+        return session
+
+
+class FakeChannel(dict):
+    def __init__(self, channel_id):
+        dict.__init__(self, channel_id=channel_id, name='Root')
+        self.messages = []
+
+    def send_text_message(self, message):
+        self.messages.append(message)
+
+
+class FakeCallbacks:
+    def __init__(self):
+        self.callbacks = {}
+
+    def set_callback(self, name, function):
+        self.callbacks[name] = function
+
+    def call(self, name, *args):
+        if name in self.callbacks:
+            self.callbacks[name](*args)
+
+
+class FakeMumble:
+    """Takes pymumble.Mumble's arguments and connects to nothing"""
+    instances = []
+
+    def __init__(self, host, port=64738, user='bot', password='', certfile=None, reconnect=False, debug=False):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.callbacks = FakeCallbacks()
+        self.sound_output = FakeSoundOutput()
+        self.users = FakeUsers(user)
+        self.channels = {0: FakeChannel(0)}
+        self.bandwidth = None
+        FakeMumble.instances.append(self)
+
+    def start(self):
+        pass
+
+    def is_ready(self):
+        pass
+
+    def set_bandwidth(self, bandwidth):
+        self.bandwidth = bandwidth
+
+    def send_text(self, session, message):
+        """Delivers a chat message from the user with the given session, on
+        the calling thread as pymumble's network thread would
+        """
+        text = types.SimpleNamespace(actor=session, message=message, channel_id=[0], session=[])
+        self.callbacks.call('text_received', text)
+
+    def messages(self):
+        return self.channels[0].messages
+
+
+def install():
+    """Makes 'import pymumble_py3' give the fake"""
+    module = types.ModuleType('pymumble_py3')
+    module.Mumble = FakeMumble
+    sys.modules['pymumble_py3'] = module
+    return module
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Runs the benchmarks against FakeMumble and prints their results as JSON.
+A run saved with --save is a baseline another run can be compared to with
+--compare, which exits with 1 if a result got worse by more than the
+tolerance.
+
+usage: run.py [--quick] [--save <file>] [--compare <file>] [--tolerance <ratio>] [benchmark ...]
+"""
+import contextlib
+import getopt
+import json
+import platform
+import subprocess as sp
+import sys
+import time
+import traceback
+
+import environment
+import bench_commands
+import bench_decode
+import bench_localplay
+import bench_playback
+import bench_queues
+
+BENCHMARKS = {'decode': bench_decode,
+              'playback': bench_playback,
+              'queues': bench_queues,
+              'localplay': bench_localplay,
+              'commands': bench_commands}
+HIGHER_IS_BETTER = ('_per_second',)
+LOWER_IS_BETTER = ('_seconds', '_percent', 'underruns', '_missing', '_failed', '_dropped')
+
+
+def command_output(command):
+    try:
+        return sp.run(command, stdout=sp.PIPE, stderr=sp.DEVNULL, cwd=environment.REPOPATH).stdout \
+            .decode('utf-8', 'replace').split('\n')[0].strip()
+    except OSError:
+        return None
+
+
+def meta(quick):
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'commit': command_output(['git', 'rev-parse', '--short', 'HEAD']),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'ffmpeg': command_output(['ffmpeg', '-version']),
+            'quick': quick}
+
+
+def run(names, quick):
+    """Runs the benchmarks, a failing one is reported in its results"""
+    env = environment.Environment()
+    results = {}
+    try:
+        for name in names:
+            print('Running ' + name, file=sys.stderr)
+            try:
+                results[name] = BENCHMARKS[name].run(env, quick)
+            except Exception as e:
+                traceback.print_exc()
+                results[name] = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+    finally:
+        env.close()
+    return results
+
+
+def better(name):
+    """Returns 1 if a higher value of the result is better, -1 if lower is,
+    0 if it is not compared
+    """
+    if name.endswith(HIGHER_IS_BETTER):
+        return 1
+    if name.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def compare(baseline, results, tolerance):
+    """Returns the descriptions of the results worse than in the baseline"""
+    regressions = []
+    for benchmark, values in sorted(results.items()):
+        old_values = baseline.get('results', {}).get(benchmark, {})
+        for name, value in sorted(values.items()):
+            old = old_values.get(name)
+            direction = better(name)
+            if not direction or not isinstance(value, (int, float)) or not isinstance(old, (int, float)):
+                continue
+            if direction > 0:
+                worse = value < old * (1 - tolerance)
+            elif name.endswith('_seconds') or name.endswith('_percent'):
+                worse = value > old * (1 + tolerance)
+            else:
+                worse = value > old  # Counts of things that should not happen
+            if worse:
+                regressions.append('{0}.{1}: {2:.6g} -> {3:.6g}'.format(benchmark, name, old, value))
+        if 'error' in values:
+            regressions.append('{0}: {1}'.format(benchmark, values['error']))
+    return regressions
+
+
+def main():
+    try:
+        opt, args = getopt.gnu_getopt(sys.argv[1:], '', ['quick', 'save=', 'compare=', 'tolerance='])
+    except getopt.GetoptError:
+        sys.exit(__doc__.strip().split('\n')[-1])
+    options = dict(opt)
+    names = args or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit('Unknown benchmark {0}, choose from {1}'.format(name, ', '.join(BENCHMARKS)))
+    quick = '--quick' in options
+    try:
+        tolerance = float(options.get('--tolerance', 0.2))
+    except ValueError:
+        sys.exit('--tolerance must be a number')
+
+    # The bot logs with print, stdout is kept for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(names, quick)
+    report = {'meta': meta(quick), 'results': results}
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if '--save' in options:
+        with open(options['--save'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if '--compare' in options:
+        with open(options['--compare']) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('quick') != quick:
+            sys.exit('The baseline was run with{0} --quick'.format('' if baseline['meta'].get('quick') else 'out'))
+        regressions = compare(baseline, results, tolerance)
+        for regression in regressions:
+            print('Regression ' + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
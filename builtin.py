@@ -1,8 +1,10 @@
+import html
+
 import handles
 
 
 def reload_modules(bot, command, arguments):
-    bot.reload_count += 1
+    """Reloads the modules whose file changed"""
     loaded_count = bot.load_modules()
     bot.send_msg_current_channel('Reloaded <b>{0}</b> bot modules'.format(loaded_count))
 
@@ -14,6 +16,7 @@ def skip(bot, command, arguments):
             leaf = int(arguments.split(';', 1)[1])
             if select == 1 and leaf == 1:
                 bot.skipLeaf = True
+                bot.wake()
                 return
             leaf -= 1  # Since leaf is an index
         except IndexError:
@@ -22,25 +25,28 @@ def skip(bot, command, arguments):
                 bot.skipLeaf = True
                 if hasattr(bot.leaf, 'branch') and bot.leaf.branch is not None:
                     bot.skipBranch = True
+                bot.wake()
                 return
         except ValueError:
             bot.send_msg_current_channel('Invalid value!')
             return
         try:
             select -= 1  # Since select is an index
-            if isinstance(bot.queue.audio[select], handles.Branch):
-                if leaf is not None:
-                    bot.queue.delete_leaf(leaf, select)
+            with bot.queue.lock:
+                if isinstance(bot.queue.audio[select], handles.Branch):
+                    if leaf is not None:
+                        bot.queue.delete_leaf(leaf, select)
+                    else:
+                        bot.queue.delete_branch(select)
                 else:
-                    bot.queue.delete_branch(select)
-            else:
-                bot.queue.delete_leaf(select)
+                    bot.queue.delete_leaf(select)
         except IndexError:
             bot.send_msg_current_channel('Invalid index')
     else:
         bot.skipLeaf = True
         if hasattr(bot.leaf, 'branch') and bot.leaf.branch is not None:
             bot.skipBranch = True
+        bot.wake()
 
 
 def chg_vol(bot, command, arguments):
@@ -65,8 +71,9 @@ def print_queue(bot, command, arguments):
     subthread. Possible states: Paused, Playing, Ready.
     """
     queue = ''
-    if bot.queue.audio:
-        for i, x in enumerate(bot.queue.audio):
+    audio, ffmpeg = bot.queue.snapshot()
+    if audio:
+        for i, x in enumerate(audio):
             if isinstance(x, handles.Branch):
                 queue += '<br />' + x.title
                 for j, y in enumerate(x):
@@ -78,7 +85,7 @@ def print_queue(bot, command, arguments):
                         else:
                             queue += '<br />|---- {0}<b> - Playing - {1}</b>'.format(title, status)
                     else:
-                        queue += '<br />|---- {0}<b> - Ready - {1}</b>'.format(title, status[9:17])
+                        queue += '<br />|---- {0}<b> - Ready - {1}</b>'.format(title, y.get_length())
             else:
                 title = x.title
                 status = x.leaf_status()
@@ -88,18 +95,17 @@ def print_queue(bot, command, arguments):
                     else:
                         queue += '<br />{0}<b> - Playing - {1}</b>'.format(title, status)
                 else:
-                    queue += '<br />{0}<b> - Ready - {1}</b>'.format(title, status[9:17])
+                    queue += '<br />{0}<b> - Ready - {1}</b>'.format(title, x.get_length())
 
-    if bot.queue.ffmpeg:
-        for z in bot.queue.ffmpeg:
-            try:
-                queue += '<br />{0}<b> - Processing</b>'.format(z.leaves[0].title)
-            except AttributeError:
-                queue += '<br />{0}<b> - Processing</b>'.format(z.title)
+    if ffmpeg:
+        for leaf in ffmpeg:
+            queue += '<br />{0}<b> - {1} - {2}</b>'.format(leaf.title, leaf.decode_status(), leaf.get_length())
 
-    for module in bot.registered_modules:
-        if hasattr(module, 'queue_append'):
-            queue += module.queue_append()
+    if audio or ffmpeg:
+        queue += '<br /><b>Total remaining: {0}</b>'.format(total_remaining(audio, ffmpeg))
+
+    for module in list(bot.modules.values()):
+        queue += module.queue_append()
 
     if queue == '':
         queue += 'Queue is empty'
@@ -107,23 +113,140 @@ def print_queue(bot, command, arguments):
     bot.send_msg_current_channel(queue)
 
 
+def total_remaining(audio, ffmpeg):
+    """Time left to play in the queues as HH:MM:SS, followed by a + if the
+    length of some leaves is not known yet
+    """
+    total = 0
+    unknown = False
+    for item in audio + ffmpeg:
+        for leaf in (item if isinstance(item, handles.Branch) else [item]):
+            seconds = leaf.get_seconds_remaining()
+            if seconds is None:
+                unknown = True
+            else:
+                total += seconds
+    return handles.sec2duration(total)[:-3] + ('+' if unknown else '')
+
+
 def toggle_pause(bot, command, arguments):
     """Toggle the pause command"""
     if bot.paused:
         bot.paused = False
     else:
         bot.paused = True
+    bot.wake()
+
+
+def quantiles(metrics, name, percentiles=(50, 95), **labels):
+    """Returns percentiles of a histogram for chat, by default the median
+    and the 95th
+    """
+    histogram = metrics.metrics.get(name)
+    if histogram is None or histogram.count(**labels) == 0:
+        return 'none yet'
+    return ', '.join('p{0} <b>{1}</b>'.format(p, format_seconds(histogram.quantile(p / 100.0, **labels)))
+                     for p in percentiles)
+
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return 'more'
+    if seconds < 1:
+        return '{0:.0f} ms'.format(seconds * 1000)
+    return '{0:g} s'.format(seconds)
+
+
+def print_stats(bot, command, arguments):
+    """Shows the audio loop's underrun and jitter counters, the command
+    executor's and a summary of the metrics of the decoding and playback
+    """
+    clock = bot.clock
+    commands = bot.commands.stats()
+    metrics = bot.supervisor.metrics
+    memory, mapped = bot.held_bytes()
+    bot.send_msg_current_channel('<br />Underruns: <b>{0}</b>'
+                                 '<br />Jitter: <b>{1:.2f} ms</b> mean, <b>{2:.2f} ms</b> max over {3} frames'
+                                 .format(clock.underruns, clock.jitter_mean() * 1000,
+                                         clock.jitter_max * 1000, clock.ticks) +
+                                 '<br />Output buffer: <b>{0:.0f} ms</b> now, {1}'
+                                 .format(bot.client.sound_output.get_buffer_size() * 1000,
+                                         quantiles(metrics, 'mj_output_buffer_seconds', (5, 50), bot=bot.user)) +
+                                 '<br />Queues: <b>{0}</b> decoding, <b>{1}</b> ready, PCM held: <b>{2:.1f} MB</b> '
+                                 'in memory, {3:.1f} MB mapped'
+                                 .format(bot.queue_leaves('ffmpeg'), bot.queue_leaves('audio'),
+                                         memory / 2 ** 20, mapped / 2 ** 20) +
+                                 '<br />Decode: {0}, until playable: {1}'
+                                 .format(quantiles(metrics, 'mj_decode_seconds'),
+                                         quantiles(metrics, 'mj_decode_ready_seconds')) +
+                                 '<br />Queued to first audio: {0}'
+                                 .format(quantiles(metrics, 'mj_first_audio_seconds', bot=bot.user)) +
+                                 '<br />Commands: <b>{busy}</b>/{workers} running, <b>{pending}</b> waiting '
+                                 '(max {max_pending}), {completed} done, {failed} failed, {timed_out} timed out, '
+                                 '{rejected} dropped, {rate_limited} rate limited'
+                                 '<br />Command wait: <b>{wait:.1f} ms</b> mean, run: <b>{run:.1f} ms</b> mean'
+                                 .format(wait=commands['mean_wait'] * 1000, run=commands['mean_run'] * 1000,
+                                         **commands) +
+                                 ', ' + quantiles(metrics, 'mj_command_seconds'))
+
+
+def format_bytes(size):
+    if size < 2 ** 20:
+        return '{0:.0f} kB'.format(size / 2 ** 10)
+    return '{0:.1f} MB'.format(size / 2 ** 20)
+
+
+def format_profile(report):
+    """Summary of a profile for the chat, the details are in its files"""
+    if report is None:
+        return 'Profiling stopped, the report could not be written'
+    summary = '<br />Profiled <b>{0:.0f} s</b>, {1} samples, report in {2}' \
+        .format(report['seconds'], report['samples'], html.escape(report['files'][0]))
+    summary += '<br />CPU: ' + ', '.join('{0} <b>{1:.2f} s</b>'.format(html.escape(label), seconds)
+                                        for label, seconds in report['threads'][:5])
+    summary += '<br />Running: ' + ', '.join('{0} <b>{1}</b>'.format(html.escape(name), count)
+                                            for name, count in report['functions'][:5])
+    if report['memory']:
+        summary += '<br />Allocated: ' + ', '.join('{0} <b>{1}</b>'.format(html.escape(site), format_bytes(size))
+                                                  for site, size, count in report['memory'][:3])
+    return summary
+
+
+def profile(bot, command, arguments):
+    """Starts or stops profiling every thread of the process, the summary of
+    the report is posted when it stops. memory shows what was allocated so
+    far. Associated with the profile command, for admins only.
+    """
+    profiler = bot.supervisor.profiler
+    if arguments == 'start':
+        if profiler.start(lambda report: bot.send_msg_current_channel(format_profile(report))):
+            bot.send_msg_current_channel('Profiling for at most {0}, <b>!profile stop</b> to stop'
+                                         .format(format_seconds(profiler.max_seconds)))
+        else:
+            bot.send_msg_current_channel('Already profiling')
+    elif arguments == 'stop':
+        if not profiler.stop():
+            bot.send_msg_current_channel('Not profiling')
+    elif arguments == 'memory':
+        sites = profiler.memory()
+        if sites is None:
+            bot.send_msg_current_channel('Not profiling')
+        else:
+            bot.send_msg_current_channel('<br />Allocated while profiling:' + ''.join(
+                '<br />{0} <b>{1}</b> in {2} blocks'.format(html.escape(site), format_bytes(size), count)
+                for site, size, count in sites))
+    else:
+        bot.send_msg_current_channel('{0}, <b>!profile start</b>, <b>stop</b> or <b>memory</b>'
+                                     .format('Profiling' if profiler.running() else 'Not profiling'))
 
 
 def seek(bot, command, arguments):
-    mod_arg = arguments.replace(':', '').zfill(6)
-    new_time = '{0}:{1}:{2}.00'.format(mod_arg[0:2], mod_arg[2:4], mod_arg[4:6])
     try:
-        seconds = handles.duration2sec(new_time)
+        seconds = handles.parse_time(arguments)
     except ValueError:
         bot.send_msg_current_channel('Invalid time')
         return
-    if 0 <= seconds <= handles.duration2sec(bot.leaf.duration):
-        bot.leaf.seek(seconds)
-    else:
+    if bot.leaf is None:
+        bot.send_msg_current_channel('Nothing is playing')
+    elif not bot.decoders.seek(bot, bot.leaf, seconds):
         bot.send_msg_current_channel('Cannot seek to specified value.')
@@ -0,0 +1,277 @@
+import collections
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+
+
+def cache_key(leaf):
+    """Returns the key of the leaf's decoded audio in the PCMCache. Local files
+    are keyed by path, modification time and size, piped audio and source
+    commands only have a key if the module that added them gave one.
+    """
+    if leaf.cache_key is not None:
+        source = leaf.cache_key
+    elif leaf.pipe or leaf.source is not None:
+        return None
+    elif os.path.isfile(leaf.file):
+        stat = os.stat(leaf.file)
+        source = '{0}:{1}:{2}'.format(os.path.abspath(leaf.file), stat.st_mtime_ns, stat.st_size)
+    else:
+        source = leaf.file  # URL given to ffmpeg
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+class PCMCache:
+    """Content-addressed cache of decoded 48 kHz s16le PCM on disk, evicting
+    the least recently used tracks to stay under max_size bytes. Recency is
+    kept in the files' modification times, so it survives restarts.
+    """
+    extension = '.pcm'
+
+    def __init__(self, folder, max_size):
+        self.folder = os.path.abspath(folder)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # Key to size, least recent first
+        self.size = 0
+        if not os.path.exists(self.folder):
+            os.mkdir(self.folder)
+        files = []
+        for fn in os.listdir(self.folder):
+            path = os.path.join(self.folder, fn)
+            if fn.endswith('.part'):
+                os.remove(path)  # Left over by an interrupted decode
+            elif fn.endswith(self.extension):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, fn[:-len(self.extension)], stat.st_size))
+        for mtime, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        with self.lock:
+            self.evict(0)
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns the cache set in config.json, or None if it is disabled"""
+        try:
+            if not config['cache']['enabled']:
+                return None
+            return cls(config['cache']['folder'], int(float(config['cache']['max_size_mb']) * 2 ** 20))
+        except (KeyError, ValueError):
+            return None
+
+    def path(self, key, extension=None):
+        return os.path.join(self.folder, key + (extension or self.extension))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def open(self, key):
+        """Returns the cached PCM of key memory-mapped, or None on a miss"""
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            path = self.path(key)
+            try:
+                os.utime(path)
+                with open(path, 'rb') as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                self.remove(key)
+                return None
+
+    def writer(self, key):
+        return CacheWriter(self, key)
+
+    def add(self, key, tmp_path, size):
+        """Moves a fully written temporary file into the cache"""
+        with self.lock:
+            if size > self.max_size:
+                os.remove(tmp_path)
+                return
+            if key in self.entries:
+                self.remove(key)
+            self.evict(size)
+            os.replace(tmp_path, self.path(key))
+            self.entries[key] = size
+            self.size += size
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self, needed):
+        """Removes least recently used entries until needed bytes fit"""
+        while self.entries and self.size + needed > self.max_size:
+            self.remove(next(iter(self.entries)))
+
+
+class CacheWriter:
+    """Writes decoded PCM to a temporary file, which only enters the cache
+    once the decoding went through to the end
+    """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.tmp_path = cache.path(key, '.{0}.part'.format(threading.get_ident()))
+        self.file = open(self.tmp_path, 'wb')
+        self.size = 0
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        try:
+            self.file.write(data)
+            self.size += len(data)
+        except OSError as e:
+            print('Could not write to the cache: ' + str(e))
+            self.failed = True
+
+    def commit(self):
+        if self.failed:
+            self.discard()
+            return
+        self.file.close()
+        self.cache.add(self.key, self.tmp_path, self.size)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+class ImageCache(PCMCache):
+    """Images ready to be sent, as the data URI of their final encoding, kept
+    in memory and on disk under max_size bytes with the least recently used
+    evicted first
+    """
+    extension = '.b64'
+
+    def __init__(self, folder, max_size):
+        self.payloads = {}
+        PCMCache.__init__(self, folder, max_size)
+        for key in list(self.entries):
+            try:
+                with open(self.path(key)) as f:
+                    self.payloads[key] = f.read()
+            except OSError:
+                with self.lock:
+                    self.remove(key)
+
+    def get(self, key):
+        """Returns the data URI of key, or None on a miss"""
+        with self.lock:
+            payload = self.payloads.get(key)
+            if payload is None:
+                return None
+            self.entries.move_to_end(key)
+            try:
+                os.utime(self.path(key))
+            except OSError:
+                pass
+            return payload
+
+    def set(self, key, payload):
+        data = payload.encode('ascii')
+        writer = self.writer(key)
+        writer.write(data)
+        writer.commit()
+        with self.lock:
+            if key in self.entries:
+                self.payloads[key] = payload
+
+    def remove(self, key):
+        self.payloads.pop(key, None)
+        PCMCache.remove(self, key)
+
+
+class LoudnessStore:
+    """Integrated loudness of tracks by cache key, saved as JSON in the cache
+    folder so no track is analysed twice, or only kept in memory without one
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.values = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.values = json.load(f)
+            except (OSError, ValueError):
+                print('Could not read the loudness of cached tracks')
+
+    @classmethod
+    def from_config(cls, config):
+        try:
+            if config['cache']['enabled']:
+                folder = os.path.abspath(config['cache']['folder'])
+                if not os.path.exists(folder):
+                    os.mkdir(folder)
+                return cls(os.path.join(folder, 'loudness.json'))
+        except KeyError:
+            pass
+        return cls()
+
+    def get(self, key):
+        if key is None:
+            return None
+        return self.values.get(key)
+
+    def set(self, key, loudness):
+        if key is None or loudness is None:
+            return
+        with self.lock:
+            self.values[key] = loudness
+            if self.path is None:
+                return
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.values, f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print('Could not save the loudness of tracks: ' + str(e))
+
+
+class TTLCache:
+    """Thread-safe in-memory mapping whose entries expire ttl seconds after
+    they were set, holding at most max_entries by evicting the least recently
+    used
+    """
+    def __init__(self, ttl, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # Key to (expiry, value)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                expiry, value = self.entries[key]
+            except KeyError:
+                return default
+            if expiry < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,248 @@
+import collections
+import functools
+import threading
+import time
+import traceback
+
+WATCHDOG_PERIOD = 1.0
+
+
+class Command:
+    """A command sent in chat, waiting for or running on a worker"""
+    __slots__ = ('bot', 'user', 'name', 'arguments', 'function', 'lane', 'timeout',
+                 'queued', 'started', 'timed_out')
+
+    def __init__(self, bot, user, name, arguments, function, timeout):
+        self.bot = bot
+        self.user = user
+        self.name = name
+        self.arguments = arguments
+        self.function = function
+        self.lane = (id(bot), user)
+        self.timeout = timeout
+        self.queued = time.monotonic()
+        self.started = None
+        self.timed_out = False
+
+
+class CommandExecutor:
+    """Runs the bots' commands on a pool of worker threads, so pymumble's
+    thread only queues them. The commands of a user on a bot form a lane and
+    run one at a time in the order they were sent, the lanes are served in
+    turn. A command running past its timeout is reported in chat and its
+    worker replaced so the other lanes keep being served, up to workers
+    replaced workers still running, while its own lane waits for it to
+    return. Each user may send rate commands every period seconds, at most
+    max_pending commands wait at once.
+    """
+    def __init__(self, workers=4, max_pending=64, timeout=30, timeouts=None, rate=5, period=10, metrics=None):
+        self.size = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.timeouts = timeouts or {}  # Command name to its own timeout
+        self.rate = rate
+        self.period = period
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.lanes = collections.OrderedDict()  # Lane to its waiting commands, in the order lanes are served
+        self.busy = set()  # Lanes with a command running
+        self.running = {}  # Worker to its command
+        self.history = {}  # User to the times of their last commands
+        self.warned = {}  # User to when they were last told to slow down
+        self.workers = []
+        self.pending = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.retired = 0  # Replaced workers still running their command
+        self.unreplaced = 0
+        self.rejected = 0
+        self.limited = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.latency = None
+        self.waits = None
+        if metrics is not None:
+            self.latency = metrics.histogram('mj_command_seconds', 'Time commands took to run, by command')
+            self.waits = metrics.histogram('mj_command_wait_seconds', 'Time commands waited for a worker')
+            metrics.gauge('mj_commands_pending', 'Commands waiting for a worker').set_function(lambda: self.pending)
+            metrics.gauge('mj_commands_running', 'Commands running').set_function(lambda: len(self.running))
+            metrics.gauge('mj_command_workers_retired', 'Replaced workers still running a timed out command') \
+                .set_function(lambda: self.retired)
+            for name, description, attribute in (
+                    ('mj_commands_total', 'Commands queued', 'submitted'),
+                    ('mj_commands_failed_total', 'Commands that raised an exception', 'failed'),
+                    ('mj_commands_timed_out_total', 'Commands that ran past their timeout', 'timed_out'),
+                    ('mj_command_workers_unreplaced_total', 'Timed out commands whose worker was not replaced, '
+                                                            'too many were already', 'unreplaced'),
+                    ('mj_commands_rejected_total', 'Commands dropped while too many were waiting', 'rejected'),
+                    ('mj_commands_rate_limited_total', 'Commands dropped by the rate limit', 'limited')):
+                metrics.counter(name, description).set_function(functools.partial(getattr, self, attribute))
+
+    @classmethod
+    def from_config(cls, config, metrics=None):
+        """Returns an executor set from the commands section of config.json,
+        reporting to the metrics registry if given
+        """
+        try:
+            section = config['commands']
+        except KeyError:
+            return cls(metrics=metrics)
+        kwargs = {'metrics': metrics}
+        for key, name, cast in (('workers', 'workers', int), ('max_pending', 'max_pending', int),
+                                ('timeout', 'timeout', float), ('rate', 'rate', int),
+                                ('rate_period', 'period', float)):
+            try:
+                kwargs[name] = cast(section[key])
+            except (KeyError, ValueError):
+                pass
+        kwargs['timeouts'] = section.get('timeouts', {})
+        return cls(**kwargs)
+
+    def start(self):
+        for i in range(max(self.size, 1)):
+            self.add_worker()
+        threading.Thread(target=self.watchdog, daemon=True).start()
+
+    def add_worker(self):
+        worker = CommandWorker(self)
+        self.workers.append(worker)
+        worker.start()
+
+    def submit(self, bot, user, name, arguments, function):
+        """Queues a command, or tells the user why it was dropped. Returns
+        True if it was queued.
+        """
+        now = time.monotonic()
+        with self.lock:
+            history = self.history.setdefault(user, collections.deque())
+            while history and history[0] <= now - self.period:
+                history.popleft()
+            if self.rate and len(history) >= self.rate:
+                self.limited += 1
+                warn = now - self.warned.get(user, -self.period) >= self.period
+                if warn:
+                    self.warned[user] = now
+                reason = 'Too many commands, <b>{0}</b>, slow down'.format(user) if warn else None
+            elif self.pending >= self.max_pending:
+                self.rejected += 1
+                reason = 'Too many commands waiting, <b>!{0}</b> was dropped'.format(name)
+            else:
+                history.append(now)
+                command = Command(bot, user, name, arguments, function, self.timeouts.get(name, self.timeout))
+                self.lanes.setdefault(command.lane, collections.deque()).append(command)
+                self.pending += 1
+                self.submitted += 1
+                self.max_depth = max(self.max_depth, self.pending)
+                self.changed.notify()
+                return True
+        if reason is not None:
+            bot.send_msg_current_channel(reason)
+        return False
+
+    def next_command(self):
+        """Returns the first command of the first lane with nothing running,
+        with the lock held, moving its lane to the back
+        """
+        for lane, commands in self.lanes.items():
+            if lane not in self.busy:
+                command = commands.popleft()
+                if commands:
+                    self.lanes.move_to_end(lane)
+                else:
+                    del self.lanes[lane]
+                return command
+        return None
+
+    def take(self, worker):
+        """Waits for a command for worker and marks it running"""
+        with self.changed:
+            self.changed.wait_for(lambda: any(lane not in self.busy for lane in self.lanes))
+            command = self.next_command()
+            self.pending -= 1
+            self.busy.add(command.lane)
+            command.started = time.monotonic()
+            self.wait_time += command.started - command.queued
+            if self.waits is not None:
+                self.waits.observe(command.started - command.queued)
+            self.running[worker] = command
+            return command
+
+    def done(self, worker, command, failed):
+        with self.changed:
+            del self.running[worker]
+            elapsed = time.monotonic() - command.started
+            self.run_time += elapsed
+            if self.latency is not None:
+                self.latency.observe(elapsed, command=command.name)
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+            if worker.retired:
+                self.retired -= 1
+            self.busy.discard(command.lane)
+            self.changed.notify()
+
+    def watchdog(self):
+        """Replaces the workers of commands running past their timeout, as
+        long as fewer than size replaced workers are still running
+        """
+        while True:
+            time.sleep(WATCHDOG_PERIOD)
+            late = []
+            now = time.monotonic()
+            with self.changed:
+                for worker, command in self.running.items():
+                    if not command.timed_out and command.timeout and now - command.started > command.timeout:
+                        command.timed_out = True
+                        self.timed_out += 1
+                        replaced = self.retired < max(self.size, 1)
+                        if replaced:
+                            self.retired += 1
+                            worker.retired = True
+                            self.workers.remove(worker)
+                            self.add_worker()
+                        else:
+                            self.unreplaced += 1
+                        late.append((command, replaced))
+            for command, replaced in late:
+                print('Command !{0} timed out after {1:.0f} s{2}'.format(
+                    command.name, now - command.started,
+                    '' if replaced else ', its worker is not replaced, too many are still running'))
+                command.bot.send_msg_current_channel('<b>!{0}</b> is taking too long'.format(command.name))
+
+    def stats(self):
+        """Returns the executor's counters as a dict"""
+        with self.lock:
+            finished = self.completed + self.failed
+            taken = self.submitted - self.pending
+            return {'workers': len(self.workers), 'busy': len(self.running), 'pending': self.pending,
+                    'max_pending': self.max_depth, 'submitted': self.submitted, 'completed': self.completed,
+                    'failed': self.failed, 'timed_out': self.timed_out, 'retired': self.retired,
+                    'unreplaced': self.unreplaced, 'rejected': self.rejected,
+                    'rate_limited': self.limited,
+                    'mean_wait': self.wait_time / taken if taken else 0.0,
+                    'mean_run': self.run_time / finished if finished else 0.0}
+
+
+class CommandWorker(threading.Thread):
+    def __init__(self, executor):
+        threading.Thread.__init__(self)
+        self.executor = executor
+        self.retired = False  # Replaced after its command timed out
+        self.daemon = True
+
+    def run(self):
+        while not self.retired:
+            command = self.executor.take(self)
+            failed = False
+            try:
+                command.function(command.bot, command.name, command.arguments)
+            except Exception:
+                failed = True
+                print("Command !{0} '{1}' failed".format(command.name, command.arguments))
+                traceback.print_exc()
+            self.executor.done(self, command, failed)
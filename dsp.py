@@ -0,0 +1,135 @@
+import numpy as np
+
+import handles
+
+NORMALIZE_RATE = 6.0  # dB per second the gain of a leaf moves at when its loudness is measured while it plays
+
+class DSP:
+    """Mixes frames of 16 bit mono PCM on their way to the sound output.
+    Applies the volume with a ramp when it changes, the loudness normalization
+    gain of each leaf, fade-ins, fade-outs and crossfades, working in place on
+    buffers allocated once.
+    """
+    def __init__(self, frame_size, volume=1.0, ramp=0.05, fade_in=0.0, fade_out=0.0, crossfade=0.0,
+                 normalize=False, target_lufs=-16.0, max_gain_db=10.0):
+        self.frame_samples = frame_size // handles.SAMPLE_WIDTH
+        self.ramp_samples = max(int(ramp * handles.SAMPLE_RATE), 1)
+        self.fade_in = int(fade_in * handles.SAMPLE_RATE)
+        self.fade_out = int(fade_out * handles.SAMPLE_RATE)
+        self.crossfade = int(crossfade * handles.SAMPLE_RATE)
+        self.normalize = normalize
+        self.target_lufs = target_lufs
+        self.max_gain_db = max_gain_db
+        self.offsets = np.arange(self.frame_samples, dtype=np.float32)
+        self.mix = np.zeros(self.frame_samples, dtype=np.float32)
+        self.work = np.zeros(self.frame_samples, dtype=np.float32)
+        self.envelope = np.zeros(self.frame_samples, dtype=np.float32)
+        self.ramp = np.zeros(self.frame_samples, dtype=np.float32)
+        self.pcm = np.zeros(self.frame_samples, dtype=np.int16)
+        self.length = 0  # Samples in the frame being mixed
+        self.gain = volume
+        self.target = volume
+        self.ramp_start = volume
+        self.ramp_position = 0
+
+    def set_volume(self, volume):
+        """Starts ramping from the current gain to volume"""
+        self.ramp_start = self.gain
+        self.target = volume
+        self.ramp_position = 0
+
+    def leaf_gain(self, leaf):
+        """Returns the normalization gain of the leaf at the start and at the
+        end of its next frame. Set from its loudness the first time it is
+        asked for, it then ramps at NORMALIZE_RATE to follow a loudness
+        measured while the leaf plays, dropping the leaf's Opus frames
+        encoded at the previous gain.
+        """
+        target = self.loudness_gain(leaf.loudness)
+        if leaf.gain is None:
+            leaf.gain = target
+        start = leaf.gain
+        if start != target:
+            step = 10 ** (NORMALIZE_RATE * self.frame_samples / handles.SAMPLE_RATE / 20)
+            leaf.gain = min(max(target, start / step), start * step)
+            leaf.frames = None
+        return start, leaf.gain
+
+    def loudness_gain(self, loudness):
+        """Linear gain bringing loudness, in LUFS, to the target"""
+        if not self.normalize or loudness is None:
+            return 1.0
+        return 10 ** (min(self.target_lufs - loudness, self.max_gain_db) / 20)
+
+    def fade_in_samples(self):
+        return max(self.fade_in, self.crossfade)
+
+    def fade_out_samples(self):
+        return max(self.fade_out, self.crossfade)
+
+    def transparent(self, position, remaining):
+        """Returns True if a frame at position would come out unchanged, which
+        is the case at unity gain away from the fades
+        """
+        return self.gain == self.target == 1.0 and position >= self.fade_in_samples() and \
+            remaining is not None and remaining - self.frame_samples >= self.fade_out_samples()
+
+    def start(self):
+        """Starts mixing a new frame"""
+        self.mix.fill(0)
+        self.length = 0
+
+    def add(self, frame, position, remaining=None, gain=1.0, end_gain=None):
+        """Mixes a frame of PCM into the output. position is the index of its
+        first sample in its leaf and remaining the samples left in the leaf
+        from there, None if not known yet, and are used for the fades. gain
+        is the normalization gain of the leaf, ramped to end_gain over the
+        frame if given.
+        """
+        n = len(frame) // handles.SAMPLE_WIDTH
+        self.work[:n] = np.frombuffer(frame, dtype=np.int16, count=n)
+        self.work[n:] = 0
+        if end_gain is None or end_gain == gain:
+            self.envelope.fill(gain)
+        else:
+            np.add(self.offsets, 1, out=self.envelope)
+            np.multiply(self.envelope, (end_gain - gain) / self.frame_samples, out=self.envelope)
+            np.add(self.envelope, gain, out=self.envelope)
+        fade_in = self.fade_in_samples()
+        if position < fade_in:
+            self.fade(position, fade_in, 1)
+        fade_out = self.fade_out_samples()
+        if fade_out and remaining is not None and remaining - self.frame_samples < fade_out:
+            self.fade(remaining, fade_out, -1)
+        np.multiply(self.work, self.envelope, out=self.work)
+        np.add(self.mix, self.work, out=self.mix)
+        self.length = max(self.length, n)
+
+    def fade(self, start, length, direction):
+        """Multiplies the envelope by a linear ramp, rising from start/length
+        if direction is 1 and falling from it if direction is -1
+        """
+        np.multiply(self.offsets, direction, out=self.ramp)
+        np.add(self.ramp, start, out=self.ramp)
+        np.divide(self.ramp, length, out=self.ramp)
+        np.clip(self.ramp, 0, 1, out=self.ramp)
+        np.multiply(self.envelope, self.ramp, out=self.envelope)
+
+    def finish(self):
+        """Applies the volume to the mixed frame and returns it as PCM"""
+        if self.gain == self.target:
+            np.multiply(self.mix, self.gain, out=self.mix)
+        else:
+            left = self.ramp_samples - self.ramp_position
+            np.add(self.offsets, 1, out=self.envelope)
+            np.minimum(self.envelope, left, out=self.envelope)
+            np.multiply(self.envelope, (self.target - self.ramp_start) / self.ramp_samples, out=self.envelope)
+            np.add(self.envelope, self.gain, out=self.envelope)
+            np.multiply(self.mix, self.envelope, out=self.mix)
+            self.ramp_position += self.frame_samples
+            self.gain = self.target if self.ramp_position >= self.ramp_samples else float(self.envelope[-1])
+        np.clip(self.mix, -32768, 32767, out=self.mix)
+        np.copyto(self.pcm, self.mix, casting='unsafe')
+        # pymumble keeps a reference to what it is given, so the frame is
+        # copied once here instead of handing out the reused buffer
+        return self.pcm[:self.length].tobytes()
@@ -1,63 +1,344 @@
+import collections
+import mmap
+import os
+import threading
+import time
+
+SAMPLE_RATE = 48000
+SAMPLE_WIDTH = 2  # 16 bit mono PCM
+BYTES_PER_SECOND = SAMPLE_RATE * SAMPLE_WIDTH
+CHUNK_SIZE = 88200  # Size of the reads from ffmpeg
+FRAME_LENGTH = 0.02  # Length of the Opus frames pymumble sends, in seconds
+FRAME_SIZE = int(SAMPLE_RATE * FRAME_LENGTH) * SAMPLE_WIDTH
+UNKNOWN_DURATION = '--:--:--'
+
+
+class RingBuffer:
+    """Bounded FIFO of PCM bytes between a decoder and the audio loop. write
+    blocks while the buffer is full, so the decoder never gets further than
+    capacity bytes ahead of playback. Reads hand out views on the buffer, the
+    space of a frame is only given back to the writer on the next read.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = bytearray(capacity)
+        self.start = 0
+        self.size = 0
+        self.held = 0  # Bytes of the last frame handed out
+        self.consumed = 0  # Bytes handed out to the audio loop
+        self.written = 0
+        self.closed = False
+        self.aborted = False
+        self.cond = threading.Condition()
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk):
+        """Copies chunk into the buffer, waiting for room. Returns False if the
+        buffer was aborted and the decoder should stop.
+        """
+        view = memoryview(chunk)
+        with self.cond:
+            while view:
+                while self.size == self.capacity and not self.aborted:
+                    self.cond.wait()
+                if self.aborted:
+                    return False
+                end = (self.start + self.size) % self.capacity
+                n = min(len(view), self.capacity - self.size, self.capacity - end)
+                self.data[end:end + n] = view[:n]
+                self.size += n
+                self.written += n
+                view = view[n:]
+                self.cond.notify_all()
+        return True
+
+    def read(self, size, timeout=None):
+        """Returns size bytes (less at the end of the stream, nothing once
+        drained), or None if they did not arrive within timeout. Frames are
+        zero-copy as long as the capacity is a multiple of size.
+        """
+        with self.cond:
+            self.release()
+            if not self.cond.wait_for(lambda: self.size >= size or self.closed, timeout):
+                return None
+            n = min(size, self.size)
+            if self.start + n <= self.capacity:
+                frame = memoryview(self.data)[self.start:self.start + n]
+                self.held = n
+                return frame
+            first = self.capacity - self.start
+            frame = bytes(self.data[self.start:]) + bytes(self.data[:n - first])
+            self.advance(n)
+            return frame
+
+    def release(self):
+        if self.held:
+            self.advance(self.held)
+            self.held = 0
+
+    def advance(self, n):
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+        self.consumed += n
+        self.cond.notify_all()
+
+    def close(self):
+        """Marks the end of the stream, buffered data can still be read"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """Drops buffered data and makes the writer stop"""
+        with self.cond:
+            self.closed = True
+            self.aborted = True
+            self.size = 0
+            self.held = 0
+            self.cond.notify_all()
+
+
 class Leaf:
-    """Represents an audio file sent to the server by MumbleJumble"""
+    """Represents an audio file sent to the server by MumbleJumble. Decoded
+    audio is held either whole in pcm, a bytearray or any other buffer, or in
+    a RingBuffer when the leaf is streamed. Positions are in bytes of PCM.
+    """
+    __slots__ = ('file', 'title', 'branch', 'pipe', 'duration', 'pcm', 'view',
+                 'buffer', 'position', 'total_bytes', 'stopped', 'worker',
+                 'progress', 'ready', 'failed', 'cache_key',
+                 'source', 'offset', 'info', 'probed', 'frames', 'loudness',
+                 'gain', 'created', 'ready_seconds')
+
     def __init__(self, audio_file, audio_title, pipe):
         self.file = audio_file
         self.title = audio_title
         self.branch = None
         self.pipe = pipe
-        self.duration = None
-        self.total_samples = None
-        self.samples = {}
-        self.current_sample = 1
+        self.duration = None  # Seconds, from ffmpeg's header until decoded
+        self.pcm = None
+        self.view = None
+        self.buffer = None
+        self.position = 0  # Next byte to be played
+        self.total_bytes = None  # Known once decoding is over
+        self.stopped = False
+        self.worker = None  # Number of the FfmpegThread processing the leaf
+        self.progress = None  # Seconds decoded so far
+        self.ready = False
+        self.failed = False
+        self.cache_key = None  # Given by modules for audio without a stable path
+        self.source = None  # Command whose output is piped into ffmpeg, or callable giving its bytes
+        self.offset = 0  # Byte the decoding of a streamed leaf starts from, moved by seeks
+        self.info = None  # probe.MediaInfo
+        self.probed = False
+        self.frames = None  # Opus packets of the whole leaf, one per FRAME_SIZE of PCM
+        self.loudness = None  # Integrated loudness in LUFS
+        self.gain = None  # Normalization gain, set when the leaf starts playing, ramped while it is measured
+        self.created = time.monotonic()
+        self.ready_seconds = None  # Time its worker took to make it playable
 
+    def held_bytes(self):
+        """Returns the bytes of decoded audio the leaf holds in memory and
+        those mapped from the PCM cache
+        """
+        if self.buffer is not None:
+            return self.buffer.capacity, 0
+        if isinstance(self.pcm, mmap.mmap):
+            return 0, len(self.pcm)
+        if self.pcm is not None:
+            return len(self.pcm), 0
+        return 0, 0
+
+    def set_pcm(self, pcm, length=None):
+        """Sets the whole decoded audio of the leaf"""
+        self.pcm = pcm
+        self.view = memoryview(pcm)
+        self.total_bytes = len(pcm) if length is None else length
+        self.duration = self.total_bytes // SAMPLE_WIDTH / float(SAMPLE_RATE)
 
-    def get_sample_length(self):
-        """Get length of sample in seconds"""
-        return duration2sec(self.duration) / float(self.total_samples)
+    def read_frame(self, size, timeout=None):
+        """Returns a view on the next size bytes of PCM (less at the very end,
+        nothing once the leaf is over), or None if a streamed leaf has nothing
+        buffered yet. The frame is only valid until the next call.
+        """
+        if self.buffer is not None:
+            buffer = self.buffer
+            frame = buffer.read(size, timeout)
+            if buffer is not self.buffer:  # Seeked in the meantime
+                return None
+        else:
+            frame = self.view[self.position:min(self.position + size, self.total_bytes)]
+        if frame:
+            self.position += len(frame)
+        return frame
+
+    def get_opus_frame(self, position):
+        """Returns the encoded frame starting at sample position, or None if
+        there is none
+        """
+        samples = FRAME_SIZE // SAMPLE_WIDTH
+        if self.frames is None or position % samples:
+            return None
+        index = position // samples
+        return self.frames[index] if index < len(self.frames) else None
+
+    def set_info(self, info):
+        """Takes what ffprobe tells about the leaf before it is decoded, its
+        length and the title in its tags, which only replaces a title made from
+        the file name
+        """
+        self.info = info
+        if info.duration and self.total_bytes is None:
+            self.duration = info.duration
+        title = info.title()
+        if title and not self.pipe and self.source is None and self.title == os.path.basename(self.file):
+            self.title = title
+
+    def stop(self):
+        """Releases the decoder of a streamed leaf that will not be played"""
+        self.stopped = True
+        if self.buffer is not None:
+            self.buffer.abort()
+
+    def get_position(self):
+        """Index of the next sample to be played"""
+        return self.position // SAMPLE_WIDTH
+
+    def get_remaining(self):
+        """Samples left to play, None while it is still being decoded"""
+        if self.total_bytes is None:
+            return None
+        return (self.total_bytes - self.position) // SAMPLE_WIDTH
+
+    def get_seconds_remaining(self):
+        """Seconds left to play, None if the length is not known yet"""
+        if self.total_bytes is not None:
+            return max(self.total_bytes - self.position, 0) / float(BYTES_PER_SECOND)
+        if self.duration:
+            return max(self.duration - self.get_seconds_elapsed(), 0)
+        return None
+
+    def get_seconds_elapsed(self):
+        return self.get_position() / float(SAMPLE_RATE)
 
     def get_time_elapsed(self):
         """Associated with the queue command"""
-        current_sec = self.current_sample * self.get_sample_length()
-        return sec2duration(current_sec)
+        return sec2duration(self.get_seconds_elapsed())
  
     def get_percent_elapsed(self):
         """Returns the completion of the song in %. Associated with the queue
         command.
         """
-        return float(self.current_sample) / float(self.total_samples) * 100
+        if self.total_bytes:
+            return self.position * 100 // self.total_bytes
+        if self.duration:
+            return min(int(self.get_seconds_elapsed() / self.duration * 100), 100)
+        return 0
+
+    def get_length(self):
+        """Length as HH:MM:SS. Associated with the queue command."""
+        if self.duration is None:
+            return UNKNOWN_DURATION
+        return sec2duration(self.duration)[:-3]
 
     def leaf_status(self):
         return '{0}/{1} ({2}%)'.format(self.get_time_elapsed()[:-3],
-                                       self.duration[:-4],
-                                       int(self.get_percent_elapsed()))
+                                       self.get_length(),
+                                       self.get_percent_elapsed())
+
+    def decode_status(self):
+        """Processing state of a leaf still in the ffmpeg queue. Associated with
+        the queue command.
+        """
+        if self.worker is None:
+            return 'Waiting'
+        status = 'Processing on worker {0}'.format(self.worker)
+        if self.progress is not None and self.duration:
+            status += ' ({0}%)'.format(int(min(self.progress / self.duration * 100, 100)))
+        return status
 
     def seek(self, seconds):
-        self.current_sample = int(seconds / self.get_sample_length()) + 1
+        """Moves playback to seconds. Returns False if it is out of the leaf.
+        A streamed leaf gets an empty buffer, which its decoder has to fill
+        again from the new offset, and the previous decoder is stopped.
+        """
+        # Aligned on frames, for the Opus frames of the leaf
+        position = int(seconds * SAMPLE_RATE) // (FRAME_SIZE // SAMPLE_WIDTH) * FRAME_SIZE
+        if position < 0 or self.total_bytes is not None and position > self.total_bytes or \
+                self.total_bytes is None and self.duration and seconds > self.duration:
+            return False
+        if self.buffer is None:
+            if self.pcm is None:
+                return False
+            self.position = position
+            return True
+        old = self.buffer
+        self.offset = position
+        self.position = position
+        self.buffer = RingBuffer(old.capacity)
+        old.abort()
+        return True
 
 
 class Branch:
-    def __init__(self, title, initleaf):
+    """Leaves queued under the same title. pending counts the leaves still in
+    the ffmpeg queue, queued is True while the branch is in the audio queue
+    and dropped once it was skipped or cleared.
+    """
+    def __init__(self, title, initleaf=None):
         self.title = title
-        initleaf.branch = self
-        self.leaves = [initleaf]
-       
+        self.leaves = collections.deque()
+        self.pending = 0
+        self.queued = False
+        self.dropped = False
+        if initleaf is not None:
+            self.append(initleaf)
+
     def __iter__(self):
-        for leaf in self.leaves:
-            yield leaf
+        return iter(list(self.leaves))
 
     def __len__(self):
         return len(self.leaves)
 
     def __contains__(self, leaf):
-        if leaf in self.leaves:
-            return True
+        return leaf in self.leaves
 
     def append(self, leaf):
+        leaf.branch = self
         self.leaves.append(leaf)
 
+    def remove(self, leaf):
+        self.leaves.remove(leaf)
+
     def remove_leaf(self, index):
         del self.leaves[index]
 
+    def count(self):
+        """Number of leaves queued, processed or not"""
+        return self.pending + len(self.leaves)
+
+
+def first_leaf(item):
+    """Returns the leaf of an element of the audio queue, which is either a
+    Leaf or the first leaf of a Branch
+    """
+    try:
+        return item.leaves[0]
+    except AttributeError:
+        return item
+
+
+def parse_time(text):
+    """Converts a time given by a user to seconds. Its digits are read as
+    HHMMSS aligned to the right, colons are ignored: 130 and 1:30 are both a
+    minute and a half, 1:3 is 13 seconds.
+    """
+    digits = text.strip().replace(':', '').zfill(6)
+    if not digits.isdigit() or len(digits) > 6:
+        raise ValueError('Invalid time ' + text)
+    return int(digits[0:2]) * 3600 + int(digits[2:4]) * 60 + int(digits[4:6])
+
 
 def duration2sec(duration):
     seconds = float(duration[8:11])
@@ -72,5 +353,5 @@ def sec2duration(seconds):
     rem = seconds % 3600
     minutes = str(int(rem / 60)).zfill(2)
     seconds = str(int(rem % 60)).zfill(2)
-    milli = str(float(rem % 60 / 10))[1:4]
+    milli = '{0:.2f}'.format(rem % 1)[1:]
     return '{0}:{1}:{2}{3}'.format(hours, minutes, seconds, milli)
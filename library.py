@@ -0,0 +1,278 @@
+import difflib
+import os
+import sqlite3
+import threading
+
+from probe import MediaInfo
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime INTEGER, link INTEGER);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, mtime INTEGER,
+                                  size INTEGER, link INTEGER, title TEXT, artist TEXT,
+                                  album TEXT, probed INTEGER, search TEXT);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_probed ON files (probed);
+'''
+# Added to files since the first version of the index, what ffprobe found:
+# audio is 1 with an audio stream, 0 without and NULL until it is known
+COLUMNS = (('audio', 'INTEGER'), ('duration', 'REAL'), ('codec', 'TEXT'), ('sample_rate', 'INTEGER'),
+           ('channels', 'INTEGER'))
+# Indexed as not audio without being probed
+NON_AUDIO_EXTENSIONS = {'.bmp', '.cue', '.db', '.doc', '.gif', '.htm', '.html', '.ini', '.jpeg', '.jpg', '.log',
+                        '.m3u', '.m3u8', '.md5', '.nfo', '.pdf', '.pls', '.png', '.rtf', '.sfv', '.txt', '.url',
+                        '.webp'}
+AUDIO = 'audio IS NOT 0'  # Condition on files that have or may have audio
+FUZZY_CANDIDATES = 500
+
+
+def normalize(path):
+    """Path relative to the root as stored in the index, '' for the root"""
+    path = os.path.normpath(path).strip('/')
+    return '' if path == '.' else path
+
+
+def glob_base(pattern):
+    """Directory of a normalized glob pattern above its first wildcard, ''
+    for the root
+    """
+    parts = pattern.split('/')[:-1]
+    for i, part in enumerate(parts):
+        if any(c in part for c in '*?['):
+            return '/'.join(parts[:i])
+    return '/'.join(parts)
+
+
+def escape(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def is_audio(name):
+    """Returns 0 for a file name that is not audio, None if it has to be probed"""
+    return 0 if os.path.splitext(name)[1].lower() in NON_AUDIO_EXTENSIONS else None
+
+
+def search_text(path, title=None, artist=None, album=None):
+    return ' '.join(x for x in (path, title, artist, album) if x).lower()
+
+
+class Library:
+    """Index of the files under root in an SQLite database. A directory is
+    only listed again when its modification time changed, so updating the
+    index of an unchanged tree costs one stat per directory. Files modified
+    in place without being renamed are not noticed until their directory
+    changes. What ffprobe found is kept until a file changes, so the files
+    that have no audio are left out when playing and files are only probed
+    once.
+    """
+    def __init__(self, root, db_path):
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        with self.db:
+            existing = {row[1] for row in self.db.execute('PRAGMA table_info(files)')}
+            for name, kind in COLUMNS:
+                if name not in existing:
+                    self.db.execute('ALTER TABLE files ADD COLUMN {0} {1}'.format(name, kind))
+            if 'audio' not in existing:  # Probed again for their audio stream
+                for path, name in self.db.execute('SELECT path, name FROM files').fetchall():
+                    audio = is_audio(name)
+                    self.db.execute('UPDATE files SET audio = ?, probed = ? WHERE path = ?',
+                                    (audio, int(audio == 0), path))
+
+    def full_path(self, path):
+        return os.path.join(self.root, path)
+
+    def update(self, path=''):
+        """Brings the index of the directory at path and of everything under
+        it up to date, by default the whole tree
+        """
+        path = normalize(path)
+        stack = [path]
+        seen = set()
+        visited = set()  # Real paths, symbolic links can make cycles
+        while stack:
+            current = stack.pop()
+            seen.add(current)
+            real = os.path.realpath(self.full_path(current))
+            if real in visited:
+                continue
+            visited.add(real)
+            stack.extend(self.refresh_dir(current))
+        with self.lock, self.db:
+            if path:
+                rows = self.db.execute("SELECT path FROM dirs WHERE path LIKE ? ESCAPE '\\'",
+                                       (escape(path) + '/%',)).fetchall()
+            else:
+                rows = self.db.execute('SELECT path FROM dirs').fetchall()
+            for (child,) in rows:
+                if child not in seen:
+                    self.forget_dir(child)
+
+    def refresh_dir(self, path):
+        """Lists the directory again if it changed since it was indexed.
+        Returns the paths of its subdirectories.
+        """
+        try:
+            mtime = os.stat(self.full_path(path)).st_mtime_ns
+        except OSError:
+            return []
+        with self.lock:
+            row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?', (path,)).fetchone()
+            if row is not None and row[0] == mtime:
+                return [p for (p,) in self.db.execute('SELECT path FROM dirs WHERE parent = ?', (path,))]
+        dirs = {}
+        files = {}
+        try:
+            with os.scandir(self.full_path(path)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            dirs[os.path.join(path, entry.name)] = entry.is_symlink()
+                        else:
+                            stat = entry.stat()
+                            files[entry.name] = (stat.st_mtime_ns, stat.st_size, entry.is_symlink())
+                    except OSError:
+                        continue
+        except OSError:
+            return []
+        with self.lock, self.db:
+            known = {name: (mtime, size) for name, mtime, size in
+                     self.db.execute('SELECT name, mtime, size FROM files WHERE dir = ?', (path,))}
+            for name in known:
+                if name not in files:
+                    self.db.execute('DELETE FROM files WHERE dir = ? AND name = ?', (path, name))
+            for name, (file_mtime, size, link) in files.items():
+                if known.get(name) != (file_mtime, size):
+                    file_path = os.path.join(path, name)
+                    audio = is_audio(name)
+                    self.db.execute('INSERT OR REPLACE INTO files (path, dir, name, mtime, size, link, probed, '
+                                    'search, audio) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (file_path, path, name, file_mtime, size, link, int(audio == 0),
+                                     search_text(file_path), audio))
+            for (child,) in self.db.execute('SELECT path FROM dirs WHERE parent = ?', (path,)).fetchall():
+                if child not in dirs:
+                    self.forget_dir(child)
+            for child, link in dirs.items():
+                # Indexed with no mtime so it gets listed
+                self.db.execute('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL, ?)', (child, path, link))
+            self.db.execute('INSERT OR IGNORE INTO dirs VALUES (?, ?, NULL, ?)',
+                            (path, os.path.dirname(path) if path else None, os.path.islink(self.full_path(path))))
+            self.db.execute('UPDATE dirs SET mtime = ? WHERE path = ?', (mtime, path))
+        return list(dirs)
+
+    def forget_dir(self, path):
+        """Removes a directory and everything under it, with the lock held"""
+        like = escape(path) + '/%'
+        self.db.execute("DELETE FROM files WHERE dir = ? OR dir LIKE ? ESCAPE '\\'", (path, like))
+        self.db.execute("DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE '\\'", (path, like))
+
+    def list_dir(self, path):
+        """Returns the subdirectories and the files of a directory as lists of
+        (name, is_link), sorted without case
+        """
+        path = normalize(path)
+        self.refresh_dir(path)
+        with self.lock:
+            dirs = [(os.path.basename(p), bool(link)) for p, link in
+                    self.db.execute('SELECT path, link FROM dirs WHERE parent = ?', (path,))]
+            files = [(name, bool(link)) for name, link in
+                     self.db.execute('SELECT name, link FROM files WHERE dir = ?', (path,))]
+        key = lambda x: x[0].lower()
+        return sorted(dirs, key=key), sorted(files, key=key)
+
+    def files(self, path):
+        """Returns the paths of the audio files under a directory, sorted"""
+        path = normalize(path)
+        with self.lock:
+            if not path:
+                rows = self.db.execute('SELECT path FROM files WHERE ' + AUDIO + ' ORDER BY path')
+            else:
+                rows = self.db.execute("SELECT path FROM files WHERE (dir = ? OR dir LIKE ? ESCAPE '\\') AND " +
+                                       AUDIO + ' ORDER BY path', (path, escape(path) + '/%'))
+            return [p for (p,) in rows]
+
+    def glob(self, pattern):
+        """Returns the paths of the audio files matching a glob pattern
+        relative to the root, sorted. * also matches across directories.
+        """
+        with self.lock:
+            return [p for (p,) in self.db.execute('SELECT path FROM files WHERE path GLOB ? AND ' + AUDIO +
+                                                  ' ORDER BY path', (normalize(pattern),))]
+
+    def random_file(self, path=None):
+        """Returns a random audio file of the directory, or of the whole tree"""
+        with self.lock:
+            if path is None:
+                row = self.db.execute('SELECT path FROM files WHERE ' + AUDIO +
+                                      ' ORDER BY RANDOM() LIMIT 1').fetchone()
+            else:
+                row = self.db.execute('SELECT path FROM files WHERE dir = ? AND ' + AUDIO +
+                                      ' ORDER BY RANDOM() LIMIT 1', (normalize(path),)).fetchone()
+        return row[0] if row else None
+
+    def search(self, query, limit=10, path=None, fuzzy=True):
+        """Returns the paths of audio files whose path or tags contain every
+        word of query, under path if given. Without any and if fuzzy, falls
+        back on the files containing the characters of query in order, best
+        matches first.
+        """
+        words = query.lower().split()
+        if not words:
+            return []
+        where = [AUDIO] + ["search LIKE ? ESCAPE '\\'"] * len(words)
+        params = ['%' + escape(word) + '%' for word in words]
+        if path:
+            where.append("(dir = ? OR dir LIKE ? ESCAPE '\\')")
+            params += [normalize(path), escape(normalize(path)) + '/%']
+        with self.lock:
+            rows = self.db.execute('SELECT path FROM files WHERE ' + ' AND '.join(where) +
+                                   ' ORDER BY length(path) LIMIT ?', params + [limit]).fetchall()
+            if rows or not fuzzy:
+                return [p for (p,) in rows]
+            where[1:len(words) + 1] = ["search LIKE ? ESCAPE '\\'"]
+            params[:len(words)] = ['%' + '%'.join(escape(c) for c in ''.join(words)) + '%']
+            rows = self.db.execute('SELECT path, name FROM files WHERE ' + ' AND '.join(where) + ' LIMIT ?',
+                                   params + [FUZZY_CANDIDATES]).fetchall()
+        query = ' '.join(words)
+        rows.sort(key=lambda row: -difflib.SequenceMatcher(None, query, row[1].lower()).ratio())
+        return [p for p, name in rows[:limit]]
+
+    def unprobed(self, limit=100):
+        """Returns files whose tags were not read yet"""
+        with self.lock:
+            return [p for (p,) in self.db.execute('SELECT path FROM files WHERE probed = 0 LIMIT ?', (limit,))]
+
+    def set_tags(self, path, info):
+        """Stores what ffprobe found about a file from its probe.MediaInfo,
+        or marks it as probed if info is None, when ffprobe failed
+        """
+        if info is None:
+            info = MediaInfo()
+            audio = None  # Left to ffmpeg
+        else:
+            audio = int(info.codec is not None)  # ffprobe selects the audio stream
+        tags = info.tags
+        title, artist, album = tags.get('title'), tags.get('artist'), tags.get('album')
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET title = ?, artist = ?, album = ?, probed = 1, search = ?, audio = ?, '
+                            'duration = ?, codec = ?, sample_rate = ?, channels = ? WHERE path = ?',
+                            (title, artist, album, search_text(path, title, artist, album), audio,
+                             info.duration, info.codec, info.sample_rate, info.channels, path))
+
+    def media_info(self, path):
+        """Returns the probe.MediaInfo stored for an audio file, or None if it
+        was not probed
+        """
+        with self.lock:
+            row = self.db.execute('SELECT duration, codec, sample_rate, channels, title, artist, album FROM files '
+                                  'WHERE path = ? AND probed = 1 AND audio = 1', (normalize(path),)).fetchone()
+        if row is None:
+            return None
+        tags = {key: value for key, value in zip(('title', 'artist', 'album'), row[4:]) if value}
+        return MediaInfo(row[0], row[1], row[2], row[3], tags)
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0]
@@ -0,0 +1,141 @@
+import ast
+import importlib.util
+import os
+import threading
+import traceback
+
+MANIFEST_ATTRIBUTES = ('commands', 'enabled', 'lazy')
+
+
+class Manifest:
+    """What a module declares without being imported: the attributes of its
+    register function assigned literals at the top level of the file, and
+    the hooks it defines. A module is lazy unless it sets register.lazy to
+    False, defines loop or computes its register attributes.
+    """
+    __slots__ = ('name', 'filename', 'signature', 'register', 'commands', 'enabled', 'lazy',
+                 'loop', 'queue_append')
+
+    def __init__(self, filename, signature):
+        self.name = os.path.basename(filename)[:-3]
+        self.filename = filename
+        self.signature = signature
+        self.register = False
+        self.commands = None
+        self.enabled = True
+        self.lazy = True
+        self.loop = False
+        self.queue_append = False
+
+
+manifests = {}  # Filename to the Manifest of its last version
+manifests_lock = threading.Lock()
+
+
+def signature(filename):
+    stat = os.stat(filename)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def read_manifest(filename):
+    """Returns the Manifest of a module file, parsed again only if the file
+    changed. Raises OSError or SyntaxError.
+    """
+    current = signature(filename)
+    with manifests_lock:
+        manifest = manifests.get(filename)
+    if manifest is not None and manifest.signature == current:
+        return manifest
+    with open(filename, 'rb') as f:
+        tree = ast.parse(f.read(), filename)
+    manifest = Manifest(filename, current)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name in ('register', 'loop', 'queue_append'):
+            setattr(manifest, node.name, True)
+        elif isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Attribute) and isinstance(target.value, ast.Name) and \
+                        target.value.id == 'register' and target.attr in MANIFEST_ATTRIBUTES:
+                    try:
+                        setattr(manifest, target.attr, ast.literal_eval(node.value))
+                    except ValueError:
+                        manifest.lazy = False  # Only known once imported
+    if manifest.loop:
+        manifest.lazy = False
+    with manifests_lock:
+        manifests[filename] = manifest
+    return manifest
+
+
+def import_file(name, filename):
+    """Imports a module file as a new module object, not shared with any
+    other bot
+    """
+    spec = importlib.util.spec_from_file_location(name, filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class BotModule:
+    """A module of a bot, imported and registered the first time one of its
+    commands is used, or right away if it is not lazy. The threads of a
+    module run while its register.stale is False, it is set once the module
+    is unloaded or replaced.
+    """
+    def __init__(self, bot, manifest):
+        self.bot = bot
+        self.manifest = manifest
+        self.module = None
+        self.failed = False
+        self.lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self.manifest.name
+
+    def load(self):
+        """Returns the module, importing and registering it the first time,
+        or None if that failed
+        """
+        with self.lock:
+            if self.module is None and not self.failed:
+                print('Loading module ', self.name)
+                try:
+                    module = import_file(self.name, self.manifest.filename)
+                    module.register.stale = False
+                    module.register(self.bot)
+                except Exception:
+                    print("Error registering module '{0}'".format(self.name))
+                    traceback.print_exc()
+                    self.failed = True
+                    return None
+                self.module = module
+            return self.module
+
+    def unload(self):
+        with self.lock:
+            if self.module is not None:
+                self.module.register.stale = True
+                self.module = None
+
+    def commands(self):
+        """Returns the module's commands, from its manifest if they are there"""
+        if self.manifest.commands is not None:
+            return self.manifest.commands
+        if self.module is not None:
+            return getattr(self.module.register, 'commands', None) or []
+        return []
+
+    def call(self, bot, command, arguments):
+        module = self.load()
+        if module is None:
+            bot.send_msg_current_channel('Module <b>{0}</b> could not be loaded'.format(self.name))
+            return
+        module.call(bot, command, arguments)
+
+    def queue_append(self):
+        module = self.module
+        if module is None or not hasattr(module, 'queue_append'):
+            return ''
+        return module.queue_append()
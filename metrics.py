@@ -0,0 +1,226 @@
+import bisect
+import http.server
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels):
+    """Formats a tuple of (name, value) pairs the way Prometheus reads them"""
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Counter:
+    """Value that only goes up, per set of labels. It may instead be read
+    from a function when the value is already counted somewhere else.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self.values = {}
+        self.functions = {}
+
+    def inc(self, amount=1, **labels):
+        labels = key(labels)
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set_function(self, function, **labels):
+        """Reads the value of labels from function when it is rendered"""
+        with self.lock:
+            self.functions[key(labels)] = function
+
+    def remove(self, **labels):
+        labels = key(labels)
+        with self.lock:
+            self.values.pop(labels, None)
+            self.functions.pop(labels, None)
+
+    def get(self, **labels):
+        labels = key(labels)
+        with self.lock:
+            function = self.functions.get(labels)
+            value = self.values.get(labels, 0)
+        return function() if function is not None else value
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+            functions = dict(self.functions)
+        for labels, function in functions.items():
+            try:
+                values[labels] = function()
+            except Exception as e:
+                print('Could not read metric {0}: {1}'.format(self.name, e))
+        for labels, value in sorted(values.items()):
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    """Value that goes up and down, per set of labels"""
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[key(labels)] = value
+
+
+class Histogram:
+    """Counts of observed values in cumulative buckets, per set of labels"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # Labels to [count per bucket, the last for +Inf, sum]
+
+    def observe(self, value, **labels):
+        labels = key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            data = self.values.get(labels)
+            if data is None:
+                data = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            data[0][i] += 1
+            data[1] += value
+
+    def remove(self, **labels):
+        with self.lock:
+            self.values.pop(key(labels), None)
+
+    def merged(self, labels=None):
+        """Returns the bucket counts and sum of labels, or of every set of
+        labels including them
+        """
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        match = set(key(labels or {}))
+        with self.lock:
+            for k, (data, value) in self.values.items():
+                if match <= set(k):
+                    counts = [a + b for a, b in zip(counts, data)]
+                    total += value
+        return counts, total
+
+    def count(self, **labels):
+        return sum(self.merged(labels)[0])
+
+    def quantile(self, q, **labels):
+        """Returns the upper bound of the bucket holding the q quantile, None
+        without observations
+        """
+        counts, total = self.merged(labels)
+        n = sum(counts)
+        if n == 0:
+            return None
+        rank = q * n
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self):
+        with self.lock:
+            values = {k: (list(data), value) for k, (data, value) in self.values.items()}
+        for labels, (counts, value) in sorted(values.items()):
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                seen += count
+                yield self.name + '_bucket', labels + (('le', format_value(bound)),), seen
+            yield self.name + '_sum', labels, value
+            yield self.name + '_count', labels, seen
+
+
+class Registry:
+    """Metrics by name, rendered in Prometheus' text format"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def get(self, cls, name, description, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, description, *args)
+            return metric
+
+    def counter(self, name, description):
+        return self.get(Counter, name, description)
+
+    def gauge(self, name, description):
+        return self.get(Gauge, name, description)
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self.get(Histogram, name, description, buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.description))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer(threading.Thread):
+    """Serves the registry on /metrics over HTTP"""
+    def __init__(self, registry, host='127.0.0.1', port=9468):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    @classmethod
+    def from_config(cls, registry, config):
+        """Returns the server set in config.json, or None if it is disabled"""
+        try:
+            if not config['metrics']['enabled']:
+                return None
+            return cls(registry, config['metrics'].get('host', '127.0.0.1'), int(config['metrics']['port']))
+        except (KeyError, ValueError):
+            return None
+        except OSError as e:
+            print('Could not serve metrics: ' + str(e))
+            return None
+
+    def run(self):
+        self.server.serve_forever()
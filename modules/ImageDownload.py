@@ -1,115 +1,159 @@
 import requests
 import os
+import io
 import base64
 import magic
 import hashlib
 import traceback
-import glob
 from PIL import Image
 from bs4 import BeautifulSoup
+from cache import ImageCache
 
-IMAGE_CACHE=".image_cache"
+IMAGE_CACHE = ".image_cache"
+IMAGE_CACHE_SIZE = 32 * 2 ** 20
 MAX_IMAGE_SIZE = 64000
+MAX_DOWNLOAD_SIZE = 20 * 2 ** 20
+DOWNLOAD_TIMEOUT = 10
+HIGHEST_QUALITY = 95
 LOWEST_QUALITY = 20
 LOWEST_SCALE = 0.10
+SCALE_STEP = 0.02  # Precision of the search over the scale
 
-def get_resized_filename(original):
-    filename, extension = os.path.splitext(original)
-    resized_filename = filename + "resized" + extension
-    return resized_filename
-
-
-def resize(original, desired_quality, scale_factor):
-    image = Image.open(original)
-    resized_filename = get_resized_filename(original)
-    width, height = image.size
-    resized_width = int(width*scale_factor)
-    resized_height = int(height*scale_factor)
-    if scale_factor is not 1:
-        image = image.resize((resized_width, resized_height), Image.ANTIALIAS) 
-    image.save(resized_filename, quality=desired_quality, optimize=True)
-    file_size = os.stat(resized_filename).st_size
-    print("Resizing image '{0}' with quality '{1}' and size factor '{2}' ({3}x{4}) - new filesize: {5}".format(resized_filename, desired_quality, scale_factor, resized_width, resized_height, file_size))
-    if file_size < MAX_IMAGE_SIZE:
-        return resized_filename
+def download(url):
+    """Returns the content at url, or None if it is bigger than
+    MAX_DOWNLOAD_SIZE
+    """
+    with requests.get(url, headers={"User-Agent": "Mozilla/5.0"}, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if int(response.headers.get('Content-Length', 0)) > MAX_DOWNLOAD_SIZE:
+            return None
+        data = bytearray()
+        for chunk in response.iter_content(64 * 1024):
+            data += chunk
+            if len(data) > MAX_DOWNLOAD_SIZE:
+                return None
+    return bytes(data)
+
+
+def encode(image, image_format, quality, scale):
+    """Returns the image scaled and saved in image_format into memory"""
+    if scale != 1:
+        width, height = image.size
+        image = image.resize((max(int(width * scale), 1), max(int(height * scale), 1)), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, image_format, quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def resize(data):
+    """Returns the image in data re-encoded under MAX_IMAGE_SIZE and its MIME
+    type, or None if it cannot be. Looks for the highest JPEG quality that
+    fits first, then for the largest scale, so the result is the largest
+    that fits. Images with transparency stay PNG and only get scaled.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    transparent = image.mode in ('RGBA', 'LA') or 'transparency' in image.info
+    if transparent:
+        image_format, mime = 'PNG', 'image/png'
+        image = image.convert('RGBA')
     else:
-        return -1
+        image_format, mime = 'JPEG', 'image/jpeg'
+        image = image.convert('RGB')
+
+    def fits(quality, scale):
+        result = encode(image, image_format, quality, scale)
+        print("Resizing image with quality '{0}' and size factor '{1:.2f}' - new filesize: {2}".format(
+            quality, scale, len(result)))
+        return result if len(result) < MAX_IMAGE_SIZE else None
+
+    quality = HIGHEST_QUALITY
+    if not transparent:
+        # Highest quality that fits at full size
+        best = None
+        low, high = LOWEST_QUALITY, HIGHEST_QUALITY
+        while low <= high:
+            quality = (low + high) // 2
+            result = fits(quality, 1)
+            if result is not None:
+                best = result
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is not None:
+            return best, mime
+        quality = LOWEST_QUALITY
+    # Largest scale that fits
+    best = fits(quality, LOWEST_SCALE)
+    if best is None:
+        return None
+    low, high = LOWEST_SCALE, 1.0
+    while high - low > SCALE_STEP:
+        scale = (low + high) / 2
+        result = fits(quality, scale)
+        if result is not None:
+            best = result
+            low = scale
+        else:
+            high = scale
+    return best, mime
+
 
 def call(bot, command_used, arguments):
     soup = BeautifulSoup(arguments, 'lxml')
 
     # extract text from potential HTML
-    text = str(soup.get_text().encode('utf-8'))
-    sha_1 = hashlib.sha1()
-    sha_1.update(text)
-
-    # reuse file names
-    unique_filename = str(sha_1.hexdigest())
+    text = soup.get_text().strip()
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
     try:
-        image_filename = IMAGE_CACHE + "/" + unique_filename 
-        cached_filename = get_resized_filename(image_filename)
-        cached_filename = glob.glob(cached_filename + "*")
-        if not cached_filename:
-            # download
-            file_handle = open(image_filename, 'wb')
-            response = requests.get(text, headers={"User-Agent": "Mozilla/5.0"})
-            file_handle.write(response.content)
-            file_handle.close()
-
-            # resize
-            file_type = magic.from_file(image_filename, mime=True)
-            file_ext = file_type.rsplit('/')[1]
-            file_size = os.stat(image_filename).st_size
-            old_filename = image_filename
-            image_filename += "." + file_ext
-            os.rename(old_filename, image_filename)
-
-            print("Downloaded '{0}' ({1}), size: {2}".format(text, file_type, file_size))
+        payload = register.cache.get(key)
+        if payload is None:
+            data = download(text)
+            if data is None:
+                bot.send_msg_current_channel("Image '{0}' is too big".format(text))
+                return -1
+            file_type = magic.from_buffer(data[:4096], mime=True)
+            print("Downloaded '{0}' ({1}), size: {2}".format(text, file_type, len(data)))
 
             if file_type == "text/html":
                 bot.send_msg_current_channel("You're getting denied by that website, sorry")
                 return -1
-            
-            resized_filename = image_filename
-            if file_size > MAX_IMAGE_SIZE:
-                # work on a copy of the original
-                print("Image {0} is too big".format(image_filename))
-                quality = 90
-                resize_factor = 1
-                giving_up = False
-                while not giving_up:
-                    resized_filename = resize(image_filename, quality, resize_factor)
-                    if resized_filename != -1:
-                        giving_up = True
-                    else:
-                        if quality > LOWEST_QUALITY:
-                            quality -= 20
-                        else: 
-                            if resize_factor > LOWEST_SCALE:
-                                quality = 100
-                                resize_factor *= 0.75
-                            else:
-                                bot.send_msg_current_channel("Giving up on image '{0}'".format(text))
-                                return -1
-            
 
+            if len(data) > MAX_IMAGE_SIZE:
+                print("Image {0} is too big".format(text))
+                resized = resize(data)
+                if resized is None:
+                    bot.send_msg_current_channel("Giving up on image '{0}'".format(text))
+                    return -1
+                data, file_type = resized
+
+            payload = "data:{0};base64,{1}".format(file_type, base64.b64encode(data).decode('ascii'))
+            register.cache.set(key, payload)
         else:
             print("Cache hit")
-            resized_filename = cached_filename[0]
-            file_type = magic.from_file(resized_filename, mime=True)
-
-        # convert to base64
-        with open(resized_filename, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read())
-            bot.send_msg_current_channel('<img src="data:{0};base64,{1}"/>'.format(file_type, encoded_string))
+        bot.send_msg_current_channel('<img src="{0}"/>'.format(payload))
     except Exception as e:
         traceback.print_exc()
 
 def register(bot):
-    if not os.path.exists(IMAGE_CACHE):
-        os.mkdir(IMAGE_CACHE)
+    try:
+        folder = bot.config['image']['cache_folder']
+    except KeyError:
+        folder = IMAGE_CACHE
+    try:
+        max_size = int(float(bot.config['image']['cache_max_size_mb']) * 2 ** 20)
+    except (KeyError, ValueError):
+        max_size = IMAGE_CACHE_SIZE
+    register.cache = bot.shared('image.cache', lambda: open_cache(folder, max_size))
+
+def open_cache(folder, max_size):
+    if os.path.isdir(folder):
+        # Downloads and resized files kept by earlier versions
+        for fn in os.listdir(folder):
+            path = os.path.join(folder, fn)
+            if not fn.endswith(ImageCache.extension) and os.path.isfile(path):
+                os.remove(path)
+    return ImageCache(folder, max_size)
 
 register.commands = ["i", "img"]
 register.enabled = True
 # register.call_in_loop = True
-
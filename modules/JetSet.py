@@ -1,9 +1,11 @@
-from __future__ import unicode_literals
-
-import urllib2
+import queue
 import random
 import threading
-import time
+
+import requests
+
+import handles
+from cache import TTLCache, cache_key
 
 MP3LISTS = {'default': 'http://jetsetradio.live/audioplayer/audio/~list.js',
             'poisonjam': 'http://jetsetradio.live/audioplayer/audio/poisonjam/~list.js',
@@ -12,21 +14,34 @@ MP3LISTS = {'default': 'http://jetsetradio.live/audioplayer/audio/~list.js',
             'rapid99': 'http://jetsetradio.live/audioplayer/audio/rapid99/~list.js',
             'immortals': 'http://jetsetradio.live/audioplayer/audio/immortals/~list.js',
             'goldenrhinos': 'http://jetsetradio.live/audioplayer/audio/goldenrhinos/~list.js'}
+MP3LIST_TTL = 6 * 3600
+HTTP_TIMEOUT = 10
+CHUNK_SIZE = 64 * 1024
+PREFETCH_SIZE = 1024 * 1024  # Bytes of a queued song downloaded before it is decoded
 
 
 def register(bot):
-    register.JetSetRadio = JetSetRadioPlayer(bot, MP3LISTS['default'])
+    # Keep-alive connections to the station are reused by every song and bot
+    register.session = bot.shared('jetset.session', new_session)
+    register.mp3lists = bot.shared('jetset.mp3lists', lambda: TTLCache(MP3LIST_TTL))
+    register.JetSetRadio = None
 
 register.commands = ['jetset']
 register.enabled = True
 
 
+def new_session():
+    session = requests.Session()
+    session.headers['User-Agent'] = 'Mozilla/5.0'
+    return session
+
+
 def call(bot, command, arguments):
     if arguments == '':
         for station in MP3LISTS.keys():
             arguments += '<b>{}</b>, '.format(station)
         bot.send_msg_current_channel('You must specify the radio station: {}'.format(arguments))
-    elif register.JetSetRadio.isAlive():
+    elif register.JetSetRadio is not None and register.JetSetRadio.is_alive():
         pass
     else:
         try:
@@ -35,42 +50,129 @@ def call(bot, command, arguments):
             bot.send_msg_current_channel('Starting <b>Jet Set Radio Live - {}</b>'.format(arguments))
         except KeyError:
             bot.send_msg_current_channel('Invalid radio station')
-        
+        except requests.RequestException:
+            bot.send_msg_current_channel('Cannot retrieve the songs of the station')
+
 
 class JetSetRadioPlayer(threading.Thread):
     def __init__(self, parent, station_url):
         threading.Thread.__init__(self)
         self.parent = parent
         self.station_url = station_url
-        self.reloadcount = self.parent.reload_count
         self.daemon = True
         self.mp3list = retrieve_mp3list(station_url)
-        self.branchname = 'Jet Set Radio Live <b>- STREAM</b>'
+        self.branch = handles.Branch('Jet Set Radio Live <b>- STREAM</b>')
 
     def run(self):
-        while self.reloadcount == self.parent.reload_count:
-            self.play_song()
-            time.sleep(0.5)
-            try:
-                mirror = self.parent.build_mirror()
-                while len(mirror[self.branchname]) >= 3:
-                    time.sleep(2)
-                    mirror = self.parent.build_mirror()
-            except KeyError:
-                return
+        while not register.stale:
+            leaf = self.play_song()
+            # Stops once the stream is skipped or the queue cleared
+            while not self.parent.queue.wait_for_room(leaf.branch, 3, 2):
+                if leaf.branch.dropped:
+                    return
 
     def play_song(self):
         song_title = random.choice(self.mp3list)
-        f = urllib2.urlopen('{0}{1}.mp3'.format(self.station_url[:-8], song_title.replace(' ', '%20')))
-        self.parent.append_audio(f.read(), song_title, self.branchname, pipe=True)
+        url = '{0}{1}.mp3'.format(self.station_url[:-8], song_title.replace(' ', '%20'))
+        song = SongStream(url)
+        pcm_cache = self.parent.pcm_cache
+        with self.parent.queue.lock:  # Started before a decoder can take the leaf
+            leaf = self.parent.append_audio(url, song_title, self.branch, source=song, cache_key=url)
+            if pcm_cache is None or cache_key(leaf) not in pcm_cache:
+                song.start(leaf)
+        return leaf
+
+
+class SongStream:
+    """Source of a queued song for the decoder. Once started, the download
+    begins right away and up to PREFETCH_SIZE bytes are held until the
+    decoder reads them, so the next song is ready while the current one
+    plays. The decoder gets the download as it arrives, and a new one if it
+    restarts or the song was not started. A prefetch is abandoned if the
+    leaf was made ready without it, from the PCM cache.
+    """
+    def __init__(self, url):
+        self.url = url
+        self.chunks = queue.Queue(PREFETCH_SIZE // CHUNK_SIZE)
+        self.leaf = None
+        self.used = False
+        self.stopped = False
+
+    def start(self, leaf):
+        self.leaf = leaf
+        threading.Thread(target=self.prefetch, daemon=True).start()
+
+    def abandoned(self):
+        leaf = self.leaf
+        return self.stopped or leaf.stopped or leaf.failed or (leaf.ready and not self.used) or \
+            (leaf.branch is not None and leaf.branch.dropped)
+
+    def put(self, chunk):
+        """Waits for room in the prefetch buffer, returns False if the song
+        will not be decoded anymore
+        """
+        while not self.abandoned():
+            try:
+                self.chunks.put(chunk, timeout=2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def prefetch(self):
+        try:
+            with register.session.get(self.url, stream=True, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if not self.put(chunk):
+                        return
+        except requests.RequestException as e:
+            print('Could not download {0}: {1}'.format(self.url, e))
+        self.put(None)
+
+    def prefetched(self):
+        try:
+            while True:
+                try:
+                    chunk = self.chunks.get(timeout=2)
+                except queue.Empty:
+                    if self.abandoned():
+                        return
+                    continue
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            self.stopped = True
+
+    def download(self):
+        try:
+            with register.session.get(self.url, stream=True, timeout=HTTP_TIMEOUT) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    yield chunk
+        except requests.RequestException as e:
+            print('Could not download {0}: {1}'.format(self.url, e))
+
+    def __call__(self):
+        if self.leaf is not None and not self.used:
+            self.used = True
+            return self.prefetched()
+        return self.download()
 
 
 def retrieve_mp3list(url):
-    l = urllib2.urlopen(url)
-    lines = l.readlines()
-    mp3_list = []
-    for line in lines:
-        start = line.find('= "') + 3
-        end = line.find('";')
-        mp3_list.append(line[start:end])
+    """Returns the songs of a station, from the cache if the list was fetched
+    less than MP3LIST_TTL seconds ago
+    """
+    mp3_list = register.mp3lists.get(url)
+    if mp3_list is None:
+        response = register.session.get(url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        mp3_list = []
+        for line in response.text.splitlines():
+            start = line.find('= "') + 3
+            end = line.find('";')
+            mp3_list.append(line[start:end])
+        register.mp3lists.set(url, mp3_list)
     return mp3_list
@@ -1,14 +1,23 @@
 import sys
 import os
-import re
 import random
+import threading
+import time
+import handles
+import probe
+import library
+from library import Library
 
 def register(bot):
     register.localplayer = LocalPlayer(bot)
+    # One indexer keeps the library shared by the bots up to date
+    register.indexer = bot.shared('localplay.indexer', lambda: start_indexer(bot, register.localplayer.library))
     print('Current local root: ' + register.localplayer.root[0])
 
-register.commands = ['cd', 'ls', 'play', 'pwd', 'rplay']
+register.commands = ['cd', 'find', 'ls', 'play', 'pwd', 'rplay']
 register.enabled = True
+register.lazy = False  # Indexes the local folder from the start
+register.folders = []  # FolderThreads queuing folders
 
 def call(bot, command, arguments):
     if command == 'pwd' and arguments == '':
@@ -25,49 +34,144 @@ def call(bot, command, arguments):
     if command == 'play':
         play_music(bot, arguments)
 
+    if command == 'find':
+        matches = register.localplayer.library.search(arguments, 20)
+        if matches:
+            bot.send_msg_current_channel(''.join('<br />/' + path for path in matches))
+        else:
+            bot.send_msg_current_channel("No audio files matching '{0}'".format(arguments))
 
     if command == 'rplay':
-        register.localplayer.ls()
-        arguments = random.randint(1, len(register.localplayer.file_l)) 
-        play_music(bot, arguments)
+        path = register.localplayer.library.random_file(register.localplayer.working_dir)
+        if path is not None:
+            add_file(bot, path)
 
 
 def play_music(bot, arguments):
+    """Adds the file with the given number in !ls, every file of a directory
+    or matching a glob pattern as a branch, shuffled after -s, or the file
+    matching the pattern in the current directory, or else anywhere in the
+    local folder
+    """
+    localplayer = register.localplayer
+    shuffle = arguments.startswith('-s ')
+    if shuffle:
+        arguments = arguments[3:].strip()
+    paths = localplayer.expand(arguments)
+    if paths is not None:
+        if not paths:
+            bot.send_msg_current_channel("No audio files matching '{0}'".format(arguments))
+            return
+        if shuffle:
+            random.shuffle(paths)
+        name = os.path.basename(arguments.rstrip('/')) or '/'
+        bot.send_msg_current_channel('Adding <b>{0} - FOLDER</b> to the queue'.format(name))
+        folder = FolderThread(bot, paths, name)
+        register.folders = [x for x in register.folders if x.is_alive()] + [folder]
+        folder.start()
+        return
+    try:
+        select = int(arguments)
+        localplayer.ls()
+        if not 1 <= select <= len(localplayer.file_l):
+            bot.send_msg_current_channel('Invalid index')
+            return
+        add_file(bot, os.path.join(localplayer.working_dir, localplayer.file_l[select - 1]))
+        return
+    except ValueError:
+        pass
+    matches = localplayer.library.search(arguments, 10, localplayer.working_dir, fuzzy=False) or \
+        localplayer.library.search(arguments, 10)
+    exact = [path for path in matches if os.path.basename(path).lower() == arguments.lower()]
+    if len(exact) == 1:
+        matches = exact
+    if len(matches) == 0:
+        bot.send_msg_current_channel("No audio files containing '{0}'".format(arguments))
+    elif len(matches) > 1:
+        bot.send_msg_current_channel("Multiple audio files containing '{0}'".format(arguments) +
+                                     ''.join('<br />/' + path for path in matches))
+    else:
+        add_file(bot, matches[0])
+
+
+def add_file(bot, path):
+    """Queues a file given relative to the local folder"""
+    bot.send_msg_current_channel('Adding <b>{0}</b> to the queue'.format(os.path.basename(path)))
+    queue_file(bot, path)
+
+
+def queue_file(bot, path, branch=None):
+    """Queues a file given relative to the local folder, to branch if given,
+    with what the indexer already probed about it, so it is not probed again
+    """
+    info = register.localplayer.library.media_info(path)
+    with bot.queue.lock:
+        leaf = bot.append_audio(os.path.join(register.localplayer.root[0], path), os.path.basename(path),
+                                branch)
+        if info is not None:
+            leaf.set_info(info)
+            leaf.probed = True
+    return leaf
+
+
+class FolderThread(threading.Thread):
+    """Queues files as one branch, keeping at most lookahead of them queued
+    so the decoders work ahead of playback without decoding the whole folder
+    """
+    def __init__(self, parent, paths, name):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.paths = paths
+        self.branch = handles.Branch('{0}<b> - FOLDER</b>'.format(name))
+        self.daemon = True
         try:
-            select = int(arguments)
-            pattern = '<br />{0}. '.format(select)
-        except ValueError:
-            pattern = arguments.lower()
+            self.lookahead = max(int(self.parent.config['localplay']['lookahead']), 1)
+        except (KeyError, ValueError):
+            self.lookahead = 4
+
+    def run(self):
+        queue = self.parent.queue
+        while self.paths and not register.stale:
+            if not queue.wait_for_room(self.branch, self.lookahead, 2):
+                if self.branch.dropped:  # Skipped or cleared
+                    return
+                continue
+            queue_file(self.parent, self.paths.pop(0), self.branch)
+
+
+def start_indexer(bot, library):
+    indexer = Indexer(bot, library)
+    indexer.start()
+    return indexer
+
+
+class Indexer(threading.Thread):
+    """Keeps the index of the local folder up to date, and reads the tags of
+    the files added to it so they can be searched. Shared by the bots, it
+    runs as long as the process.
+    """
+    def __init__(self, parent, library):
+        threading.Thread.__init__(self)
+        self.parent = parent
+        self.library = library
+        self.daemon = True
         try:
-            l = register.localplayer.ls()
-            whole_l = ''
-            for string in l:
-                whole_l += string
-                
-            start_indexes = [m.start() for m in re.finditer(pattern, whole_l.lower())]
-
-            if len(start_indexes) == 0:
-                bot.send_msg_current_channel("No audio files containing '{0}'".format(pattern.replace('<br />', '')))
-                raise Exception
-            elif len(start_indexes) > 1:
-                bot.send_msg_current_channel("Multiple audio files containing '{0}'".format(pattern.replace('<br />', '')))
-                raise Exception
-
-            start = start_indexes[0]
-
-            if '<br />' in pattern:
-                start += 6
-            else:
-                start = whole_l.rfind('<br />', 0, start) + 6
-            end = whole_l.find('<br />', start)
-            if whole_l[end] == whole_l[-1]:
-                audio_file = whole_l[start:].split(' ', 1)[1]
-            else:
-                audio_file = whole_l[start:end].split(' ', 1)[1]
-            bot.send_msg_current_channel('Adding <b>{0}</b> to the queue'.format(audio_file))
-            bot.append_audio(os.path.join(register.localplayer.root[0], register.localplayer.working_dir, audio_file), audio_file)
-        except:
-            pass
+            self.interval = float(self.parent.config['localplay']['rescan_interval'])
+        except (KeyError, ValueError):
+            self.interval = 600
+
+    def run(self):
+        while True:
+            self.library.update()
+            self.read_tags()
+            time.sleep(self.interval)
+
+    def read_tags(self):
+        paths = self.library.unprobed()
+        while paths:
+            for path in paths:
+                self.library.set_tags(path, probe.run(self.library.full_path(path)))
+            paths = self.library.unprobed()
 
 
 class LocalPlayer:
@@ -75,8 +179,33 @@ class LocalPlayer:
         self.parent = parent
         self.root = (os.path.abspath(self.parent.config['localplay']['local_folder']), '/')
         self.working_dir = '.'
+        try:
+            index = self.parent.config['localplay']['index']
+        except KeyError:
+            index = 'localplay.db'
+        self.library = self.parent.shared('localplay.library', lambda: Library(self.root[0], index))
+        self.file_l = []
 
 
+    def expand(self, arguments):
+        """Returns the files of the local folder matching arguments if it is
+        a directory or a glob pattern, relative to the current directory or to
+        the root if it starts with /, or None otherwise
+        """
+        if arguments.startswith('/'):
+            target = library.normalize(arguments)
+        else:
+            target = library.normalize(os.path.join(self.working_dir, arguments))
+        if target.startswith('..'):
+            return None
+        if any(c in arguments for c in '*?['):
+            self.library.update(library.glob_base(target))
+            return self.library.glob(target)
+        if arguments and os.path.isdir(os.path.join(self.root[0], target)):
+            self.library.update(target)
+            return self.library.files(target)
+        return None
+
     def working_path(self):
         return os.path.join(self.root[0], self.working_dir)
 
@@ -90,17 +219,9 @@ class LocalPlayer:
 
 
     def ls(self):
-        l = os.listdir(self.working_path())
-        self.dir_l = []
-        self.file_l = []
-        for element in l:
-            if os.path.isdir(os.path.join(self.working_path(), element)):
-                self.dir_l.append(element)
-            else:
-                self.file_l.append(element)
-        dir_l_sorted = sorted(self.dir_l, key=str.lower)
-        file_l_sorted = sorted(self.file_l, key=str.lower)
-        l = dir_l_sorted + file_l_sorted
+        dir_l, file_l = self.library.list_dir(self.working_dir)
+        self.file_l = [name for name, link in file_l]
+        l = dir_l + file_l
         
         clean_l = []
         for x in range(len(l) // 20):
@@ -110,12 +231,13 @@ class LocalPlayer:
         counter = 1
         for i in range(len(l)):
             j = i // 20
-            if os.path.islink(os.path.join(self.working_path(), l[i])):
-                clean_l[j] += '<br /><b><font color=#5fa5e0>{0}</font></b>'.format(l[i])
-            elif os.path.isdir(os.path.join(self.working_path(), l[i])):
-                clean_l[j] += '<br /><b>{0}</b>'.format(l[i])
+            name, link = l[i]
+            if link:
+                name = '<font color=#5fa5e0>{0}</font>'.format(name)
+            if i < len(dir_l):
+                clean_l[j] += '<br /><b>{0}</b>'.format(name)
             else:
-                clean_l[j] += '<br />{0}. {1}'.format(counter, l[i])
+                clean_l[j] += '<br />{0}. {1}'.format(counter, name)
                 counter += 1
         return clean_l
 
@@ -173,3 +295,11 @@ class LocalPlayer:
 
     def pwd(self):
         self.parent.send_msg_current_channel(os.path.join(self.root[1], self.working_dir))
+
+
+def queue_append():
+    q = ''
+    for folder in register.folders:
+        if folder.is_alive() and folder.paths:
+            q += '<br />{0}<b> - {1} more files</b>'.format(folder.branch.title, len(folder.paths))
+    return q
@@ -1,16 +1,27 @@
 from __future__ import unicode_literals
 
+import collections
+import concurrent.futures
+import math
 import threading
 import os
 import youtube_dl
 import time
-import subprocess as sp
 import random
+import handles
+from cache import TTLCache
+
+DEFAULT_ENTRY_LENGTH = 180  # Seconds assumed for entries of unknown length
+METADATA_TTL = 3600
 
 
 def register(bot):
     register.singlethread = SingleThread(bot)
     register.plthread = PlaylistThread(bot)
+    # youtube-dl instances are not thread-safe, each thread gets its own for
+    # metadata and downloads
+    register.downloaders = threading.local()
+    register.metadata = bot.shared('youtube-dl.metadata', lambda: TTLCache(METADATA_TTL))
 
 
 register.commands = ['a', 'add', 'shuffle']
@@ -32,7 +43,7 @@ def call(bot, command, arguments):
         try:
             if info['_type'] == 'playlist':
                 bot.send_msg_current_channel('Adding <b>{0} - PLAYLIST</b> to the queue'.format(title))
-                if register.plthread.isAlive():
+                if register.plthread.is_alive():
                     register.plthread + (url, info)
                 else:
                     register.plthread = PlaylistThread(bot)
@@ -40,7 +51,7 @@ def call(bot, command, arguments):
                     register.plthread.start()
         except KeyError:
             bot.send_msg_current_channel('Adding <b>{0}</b> to the queue'.format(title))
-            if register.singlethread.isAlive():
+            if register.singlethread.is_alive():
                 register.singlethread + (url, info)
             else:
                 register.singlethread = SingleThread(bot)
@@ -54,9 +65,37 @@ def call(bot, command, arguments):
             register.shuffle = False
 
 
+def media_key(info, url):
+    """Identifies audio by the extractor and id youtube-dl gave in its info,
+    or a playlist entry, so different URLs of the same video share their
+    cached audio. Falls back to url.
+    """
+    extractor = info.get('extractor_key') or info.get('ie_key')
+    if extractor and info.get('id'):
+        return '{0}:{1}'.format(extractor, info['id'])
+    return url
+
+
 def extract_info(url):
-    with youtube_dl.YoutubeDL({}) as ydl:
-        return ydl.extract_info(url, download=False, process=False)
+    """Returns youtube-dl's metadata for url, from the cache if it was
+    fetched less than METADATA_TTL seconds ago
+    """
+    info = register.metadata.get(url)
+    if info is None:
+        info = downloader().extract_info(url, download=False, process=False)
+        if info.get('_type') == 'playlist':
+            info['entries'] = list(info['entries'])  # May be a generator
+        register.metadata.set(url, info)
+    return info
+
+
+def downloader():
+    """Returns the long-lived youtube-dl instance used for metadata and
+    downloads by the current thread
+    """
+    if not hasattr(register.downloaders, 'ydl'):
+        register.downloaders.ydl = youtube_dl.YoutubeDL({'format': 'bestaudio', 'quiet': True})
+    return register.downloaders.ydl
     
 
 class SingleThread(threading.Thread):
@@ -64,7 +103,6 @@ class SingleThread(threading.Thread):
         threading.Thread.__init__(self)
         self.new_audio = []
         self.parent = parent
-        self.reload_count = self.parent.reload_count
         self.exit = False
         self.daemon = True
         self.current_title = None
@@ -82,7 +120,7 @@ class SingleThread(threading.Thread):
         self.new_audio.append(data)
 
     def run(self):
-        while self.reload_count == self.parent.reload_count and self.new_audio and not self.exit:
+        while not register.stale and self.new_audio and not self.exit:
             url = self.new_audio[0][0]
             info = self.new_audio[0][1]
             self.current_title = info['title']
@@ -90,37 +128,53 @@ class SingleThread(threading.Thread):
                 file_path = os.path.join(self.dl_folder, self.current_title)
                 self.dl_and_append(url, file_path, self.current_title)
             else:
-                self.pipe_and_append(url, self.current_title)
+                self.pipe_and_append(url, self.current_title, duration=info.get('duration'),
+                                     cache_key=media_key(info, url))
             self.current_title = None
             del self.new_audio[0]
 
-    def dl_and_append(self, url, file_path, title, branchname=None):
-        try:
-            ydl_opts = {'format': 'bestaudio', 'outtmpl': file_path}
-            with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
-            self.parent.append_audio(file_path, title, branchname)
-        except youtube_dl.DownloadError:
-            pass
+    def dl_and_append(self, url, file_path, title, branch=None):
+        if self.download_file(url, file_path):
+            self.parent.append_audio(file_path, title, branch)
 
-    def pipe_and_append(self, url, title, branchname=None):
+    def download_file(self, url, file_path):
         try:
-            command = ['youtube-dl', url, '-f', 'bestaudio', '-o', '-']
-            p = sp.Popen(command, stdout=sp.PIPE, stderr=sp.PIPE)
-            stdout, stderr = p.communicate()
-            print(stderr)
-            self.parent.append_audio(stdout, title, branchname, pipe=True)
+            ydl = downloader()
+            ydl.params['outtmpl'] = file_path
+            ydl.download([url])
+            return True
         except youtube_dl.DownloadError:
-            pass
+            return False
+
+    def pipe_and_append(self, url, title, branch=None, duration=None, cache_key=None):
+        """Queues the audio with youtube-dl as its source, the decoder pipes
+        the download into ffmpeg as it arrives. duration is the length
+        youtube-dl gave, since the download cannot be probed, and cache_key
+        identifies the audio in the PCM cache, the URL if not given.
+        """
+        command = ['youtube-dl', url, '-f', 'bestaudio', '-o', '-']
+        leaf = self.parent.append_audio(url, title, branch, source=command, cache_key=cache_key or url)
+        if duration and leaf.duration is None:
+            leaf.duration = float(duration)
+        return leaf
 
 
 class PlaylistThread(SingleThread):
+    """Prefetches the entries of playlists, a few at a time, keeping enough of
+    them queued that the branch does not run dry while entries download
+    """
     def __init__(self, bot):
         SingleThread.__init__(self, bot)
-        self.buffer_size = self.parent.config['youtube-dl']['playlist']['buffer_size']
-        self.download = self.parent.config['youtube-dl']['playlist']['download']
+        config = self.parent.config['youtube-dl']['playlist']
+        self.buffer_size = config['buffer_size']
+        self.concurrency = max(int(config.get('concurrency', 1)), 1)
+        self.max_lookahead = max(int(config.get('max_lookahead', self.buffer_size)), self.buffer_size)
+        self.fetching = []  # Titles of the entries being downloaded
+        self.fetch_times = []
+        self.appended = []  # Leaves queued for the current playlist, with the length youtube-dl gave
+        self.download = config['download']
         if self.download:
-            self.dl_folder = os.path.abspath(self.parent.config['youtube-dl']['playlist']['download_folder'])
+            self.dl_folder = os.path.abspath(config['download_folder'])
             if not os.path.exists(self.dl_folder):
                 try:
                     os.mkdir(self.dl_folder)
@@ -129,10 +183,12 @@ class PlaylistThread(SingleThread):
                     print('Could not create download folder, aborting!')
 
     def run(self):
-        while self.reload_count == self.parent.reload_count and self.new_audio and not self.exit:
+        while not register.stale and self.new_audio and not self.exit:
             info = self.new_audio[0][1]
-            branchname = info['title'] + '<b> - PLAYLIST</b>'
-            self.new_audio[0] = [('https://www.youtube.com/watch?v=' + x['url'], x['title']) for x in info['entries']]
+            branch = handles.Branch(info['title'] + '<b> - PLAYLIST</b>')
+            self.new_audio[0] = [('https://www.youtube.com/watch?v=' + x['url'], x['title'], x.get('duration'),
+                                  media_key(x, None)) for x in info['entries']]
+            playlist_path = None
             if self.download:
                 playlist_path = os.path.join(self.dl_folder, info['title'])
                 if not os.path.exists(playlist_path):
@@ -141,35 +197,94 @@ class PlaylistThread(SingleThread):
                     except OSError:
                         print('Cannot create download folder for current playlist, aborting!')
                         return
+            self.appended = []
+            with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+                self.prefetch(executor, branch, playlist_path)
+            del self.new_audio[0]
+
+    def prefetch(self, executor, branch, playlist_path):
+        """Keeps up to lookahead() entries of the playlist queued or being
+        downloaded, and appends them in the order they were picked
+        """
+        entries = self.new_audio[0]
+        queue = self.parent.queue
+        pending = collections.deque()  # (entry, future), in the order they will be appended
 
-            while self.new_audio[0]:
+        def room():
+            return entries and len(pending) < self.concurrency and \
+                len(pending) + queue.branch_count(branch) < self.lookahead()
+
+        while not register.stale and (entries or pending):
+            if branch.dropped:  # Skipped or cleared
+                break
+            while room():
                 if register.shuffle:
-                    current = random.choice(self.new_audio[0])
+                    current = random.choice(entries)
                 else:
-                    current = self.new_audio[0][0]
-                self.current_title = current[1]
+                    current = entries[0]
+                entries.remove(current)
+                self.fetching.append(current[1])
+                future = executor.submit(self.fetch, current, playlist_path)
+                future.add_done_callback(lambda f: queue.notify())
+                pending.append((current, future))
+            if pending and pending[0][1].done():
+                current, future = pending.popleft()
+                self.fetching.remove(current[1])
+                result = future.result()
+                if result is None:
+                    continue
                 if self.download:
-                    file_path = os.path.join(playlist_path, self.current_title)
-                    self.dl_and_append(current[0], file_path, self.current_title, branchname)
+                    leaf = self.parent.append_audio(result, current[1], branch)
                 else:
-                    self.pipe_and_append(current[0], self.current_title, branchname)
-                self.new_audio[0].remove(current)
-                self.current_title = None
-                time.sleep(0.5)
-                try:
-                    mirror = self.parent.build_mirror()
-                    while len(mirror[branchname]) >= self.buffer_size:
-                        time.sleep(2)
-                        mirror = self.parent.build_mirror()
-                except KeyError:
-                    break
-            del self.new_audio[0]
+                    leaf = self.pipe_and_append(result, current[1], branch, current[2], current[3])
+                self.appended.append((leaf, current[2]))
+                continue
+            with queue.changed:
+                # Woken up when a leaf finishes playing or a download is done
+                queue.changed.wait_for(lambda: room() or (pending and pending[0][1].done()) or branch.dropped, 10)
+        for current, future in pending:
+            future.cancel()
+        self.fetching = []
+
+    def fetch(self, entry, playlist_path):
+        """Downloads an entry if the playlist is downloaded. Returns the file
+        or URL to queue, or None if the download failed.
+        """
+        if not self.download:
+            return entry[0]  # youtube-dl runs in the decoder
+        start = time.monotonic()
+        file_path = os.path.join(playlist_path, entry[1])
+        if not self.download_file(entry[0], file_path):
+            return None
+        self.fetch_times.append(time.monotonic() - start)
+        return file_path
+
+    def lookahead(self):
+        """Number of entries to keep queued ahead of playback. Grows from
+        buffer_size when fetching an entry takes long compared to playing
+        one, so every download slot stays busy. Piped entries are fetched by
+        the decoder, their fetch time is how long it took to make them
+        playable.
+        """
+        if self.download:
+            fetch_times = self.fetch_times[-5:]
+        else:
+            fetch_times = [leaf.ready_seconds for leaf, duration in self.appended
+                           if leaf.ready_seconds is not None][-5:]
+        if not fetch_times:
+            return self.buffer_size
+        fetch_time = sum(fetch_times) / len(fetch_times)
+        durations = [leaf.duration or duration for leaf, duration in self.appended if leaf.duration or duration]
+        play_time = sum(durations) / len(durations) if durations else DEFAULT_ENTRY_LENGTH
+        depth = self.concurrency + int(math.ceil(fetch_time / max(play_time, 1)))
+        return max(self.buffer_size, min(depth, self.max_lookahead))
 
 
 def queue_append():
     q = ''
-    if register.singlethread.isAlive() and register.singlethread.current_title is not None:
+    if register.singlethread.is_alive() and register.singlethread.current_title is not None:
         q += '<br />{0}<b> - Downloading</b>'.format(register.singlethread.current_title)
-    if register.plthread.isAlive() and register.plthread.current_title is not None:
-        q += '<br />{0}<b> - Downloading</b>'.format(register.plthread.current_title)
+    if register.plthread.is_alive():
+        for title in register.plthread.fetching:
+            q += '<br />{0}<b> - Downloading</b>'.format(title)
     return q
@@ -0,0 +1,220 @@
+import hashlib
+import queue
+import struct
+import threading
+
+import numpy as np
+import opuslib
+
+import handles
+from cache import PCMCache
+
+OPUS_PROFILE = 'audio'  # Same application as pymumble's encoder
+# Internals of the SoundOutput of pymumble_py3 1.6 the cached frames go through,
+# install and send were written against that version
+SOUND_OUTPUT_ATTRIBUTES = ('encoder', 'lock', 'pcm')
+
+
+class OpusFrame:
+    """Opus packet queued in pymumble's sound output in place of a PCM chunk.
+    Its length is the one of the PCM it encodes, so the sound output counts
+    it like any other chunk. Keeps that PCM, before the gain the packet was
+    encoded with, for the live encoder to catch up on.
+    """
+    __slots__ = ('opus', 'size', 'pcm', 'gain')
+
+    def __init__(self, opus, size, pcm=None, gain=None):
+        self.opus = opus
+        self.size = size
+        self.pcm = pcm
+        self.gain = gain
+
+    def __len__(self):
+        return self.size
+
+    def samples(self):
+        """Returns the PCM the packet encodes, a whole frame with its gain"""
+        frame = self.pcm
+        if len(frame) < handles.FRAME_SIZE:
+            frame += bytes(handles.FRAME_SIZE - len(frame))
+        if self.gain is not None and self.gain != 1.0:
+            frame = apply_gain(frame, self.gain)
+        return frame
+
+
+class FrameEncoder:
+    """Wraps the sound output's Opus encoder, passing OpusFrames through as
+    they are and encoding everything else. The encoder does not see the
+    audio of the OpusFrames, and its lookahead would still hold what came
+    before them when live audio follows, so it first encodes the last
+    OpusFrame's PCM and drops the packet. The cached frames come from one
+    encoder run over the whole leaf, so switching to them needs nothing.
+    """
+    def __init__(self, encoder):
+        self.encoder = encoder
+        self.last = None  # OpusFrame passed through last, until live audio follows
+
+    def encode(self, pcm, frame_size):
+        if isinstance(pcm, OpusFrame):
+            self.last = pcm
+            return pcm.opus
+        last, self.last = self.last, None
+        if last is not None and last.pcm is not None:
+            self.encoder.encode(last.samples(), handles.FRAME_SIZE // handles.SAMPLE_WIDTH)
+        return self.encoder.encode(pcm, frame_size)
+
+    @property
+    def bitrate(self):
+        return self.encoder.bitrate
+
+    @bitrate.setter
+    def bitrate(self, value):
+        self.encoder.bitrate = value
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+
+def install(sound_output):
+    """Wraps the encoder of sound_output, which pymumble replaces whenever the
+    codec changes. Returns its bitrate, or None if it has no encoder yet or
+    is not a sound output cached frames can be sent through.
+    """
+    if not all(hasattr(sound_output, name) for name in SOUND_OUTPUT_ATTRIBUTES):
+        if not install.warned:
+            install.warned = True
+            print('Opus cache disabled, this version of pymumble has no {0} in its sound output'
+                  .format(', '.join(SOUND_OUTPUT_ATTRIBUTES)))
+        return None
+    encoder = sound_output.encoder
+    if encoder is None:
+        return None
+    if not isinstance(encoder, FrameEncoder):
+        sound_output.encoder = encoder = FrameEncoder(encoder)
+    return encoder.bitrate
+
+
+install.warned = False
+
+
+def send(sound_output, opus, pcm=None, gain=None):
+    """Queues an encoded frame in sound_output, after the audio already there.
+    pcm is the frame it encodes, copied since frames are views on the leaf,
+    and gain the one it was encoded with.
+    """
+    frame = OpusFrame(opus, handles.FRAME_SIZE, bytes(pcm) if pcm is not None else None, gain)
+    with sound_output.lock:
+        sound_output.pcm.append(frame)
+
+
+def frames_key(pcm_key, bitrate, gain=1.0):
+    source = '{0}:{1}:{2}:{3:.4f}'.format(pcm_key, bitrate, handles.FRAME_SIZE, gain)
+    return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+
+def apply_gain(frame, gain):
+    samples = np.frombuffer(frame, dtype=np.int16).astype(np.float32)
+    np.multiply(samples, gain, out=samples)
+    np.clip(samples, -32768, 32767, out=samples)
+    return samples.astype(np.int16).tobytes()
+
+
+def encode(pcm, bitrate, gain=1.0):
+    """Encodes 48 kHz mono s16le PCM into Opus frames, returned as one bytes
+    object where each frame is preceded by its length on two bytes. gain is
+    applied to the PCM first.
+    """
+    encoder = opuslib.Encoder(handles.SAMPLE_RATE, 1, OPUS_PROFILE)
+    encoder.bitrate = bitrate
+    samples = handles.FRAME_SIZE // handles.SAMPLE_WIDTH
+    data = bytearray()
+    view = memoryview(pcm)
+    for start in range(0, len(view), handles.FRAME_SIZE):
+        frame = bytes(view[start:start + handles.FRAME_SIZE])
+        if len(frame) < handles.FRAME_SIZE:
+            frame += bytes(handles.FRAME_SIZE - len(frame))
+        if gain != 1.0:
+            frame = apply_gain(frame, gain)
+        packet = encoder.encode(frame, samples)
+        data += struct.pack('<H', len(packet)) + packet
+    return data
+
+
+def split(data):
+    """Returns the frames written by encode as a list"""
+    frames = []
+    i = 0
+    while i < len(data):
+        n = struct.unpack_from('<H', data, i)[0]
+        frames.append(bytes(data[i + 2:i + 2 + n]))
+        i += 2 + n
+    return frames
+
+
+class OpusCache(PCMCache):
+    """Opus frames of the tracks in the PCM cache, encoded once at the bitrate
+    of the sound output, next to their PCM and with their own size limit
+    """
+    extension = '.opus'
+
+    @classmethod
+    def from_config(cls, config):
+        try:
+            if not config['cache']['enabled'] or not config['cache']['opus']:
+                return None
+            return cls(config['cache']['folder'], int(float(config['cache']['opus_max_size_mb']) * 2 ** 20))
+        except (KeyError, ValueError):
+            return None
+
+    def load(self, key):
+        """Returns the cached frames of key as a list, or None on a miss"""
+        data = self.open(key)
+        if data is None:
+            return None
+        try:
+            return split(data)
+        finally:
+            data.close()
+
+
+class OpusEncodeThread(threading.Thread):
+    """Encodes tracks of the PCM cache into the Opus cache in the background,
+    one at a time
+    """
+    def __init__(self, pcm_cache, opus_cache):
+        threading.Thread.__init__(self)
+        self.pcm_cache = pcm_cache
+        self.opus_cache = opus_cache
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.daemon = True
+
+    def add(self, pcm_key, bitrate, gain=1.0):
+        """Schedules the encoding of pcm_key unless it is cached or scheduled"""
+        key = frames_key(pcm_key, bitrate, gain)
+        with self.lock:
+            if key in self.opus_cache or key in self.pending:
+                return
+            self.pending.add(key)
+        self.jobs.put((pcm_key, bitrate, gain, key))
+
+    def run(self):
+        while True:
+            pcm_key, bitrate, gain, key = self.jobs.get()
+            try:
+                pcm = self.pcm_cache.open(pcm_key)
+                if pcm is None:
+                    continue
+                try:
+                    data = encode(pcm, bitrate, gain)
+                finally:
+                    pcm.close()
+                writer = self.opus_cache.writer(key)
+                writer.write(data)
+                writer.commit()
+            except (opuslib.OpusError, OSError) as e:
+                print('Could not encode to Opus: ' + str(e))
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
@@ -0,0 +1,108 @@
+import json
+import os
+import subprocess as sp
+
+from cache import TTLCache
+
+PROBE_TTL = 24 * 3600
+PROBE_TIMEOUT = 30
+
+
+class MediaInfo:
+    """What ffprobe tells about an input before it is decoded. duration is in
+    seconds, None if the container does not say.
+    """
+    __slots__ = ('duration', 'codec', 'sample_rate', 'channels', 'tags')
+
+    def __init__(self, duration=None, codec=None, sample_rate=None, channels=None, tags=None):
+        self.duration = duration
+        self.codec = codec
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.tags = tags if tags is not None else {}
+
+    def title(self):
+        """Returns 'Artist - Title' from the tags, or None without a title tag"""
+        title = self.tags.get('title')
+        if not title:
+            return None
+        artist = self.tags.get('artist') or self.tags.get('album_artist')
+        if artist:
+            return '{0} - {1}'.format(artist, title)
+        return title
+
+
+def probe_key(leaf):
+    """Returns the key of the leaf in the probe cache, or None if it should not
+    be probed. Local files are keyed by path, modification time and size.
+    """
+    if leaf.source is not None:
+        return None  # Piped from a download, the module knows its length
+    if leaf.pipe:
+        return leaf.cache_key
+    if os.path.isfile(leaf.file):
+        stat = os.stat(leaf.file)
+        return '{0}:{1}:{2}'.format(os.path.abspath(leaf.file), stat.st_mtime_ns, stat.st_size)
+    return leaf.file  # URL given to ffmpeg
+
+
+def parse(output):
+    """Builds a MediaInfo from ffprobe's JSON output"""
+    data = json.loads(output.decode('utf-8', 'replace'))
+    fmt = data.get('format', {})
+    streams = data.get('streams', [])
+    stream = streams[0] if streams else {}
+    info = MediaInfo(codec=stream.get('codec_name'))
+    for value, attribute in ((fmt.get('duration'), 'duration'), (stream.get('duration'), 'duration'),
+                             (stream.get('sample_rate'), 'sample_rate'), (stream.get('channels'), 'channels')):
+        if getattr(info, attribute) is None and value is not None:
+            try:
+                setattr(info, attribute, float(value) if attribute == 'duration' else int(value))
+            except ValueError:
+                pass  # 'N/A'
+    for tags in (stream.get('tags', {}), fmt.get('tags', {})):
+        for key, value in tags.items():
+            info.tags[key.lower()] = value
+    return info
+
+
+def run(target, data=None):
+    """Runs ffprobe on a path or URL, or on data through its stdin if target
+    is '-'. Returns a MediaInfo, or None if ffprobe failed.
+    """
+    command = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format',
+               '-show_streams', '-select_streams', 'a:0', '-i', target]
+    try:
+        p = sp.run(command, input=data, stdout=sp.PIPE, stderr=sp.DEVNULL, timeout=PROBE_TIMEOUT)
+    except (OSError, sp.TimeoutExpired):
+        return None
+    if p.returncode != 0:
+        return None
+    try:
+        return parse(p.stdout)
+    except ValueError:
+        return None
+
+
+class Prober:
+    """Runs ffprobe on leaves before they are decoded, keeping the results
+    for PROBE_TTL seconds
+    """
+    def __init__(self):
+        self.cache = TTLCache(PROBE_TTL, 4096)
+
+    def probe(self, leaf):
+        """Returns the leaf's MediaInfo, or None if it cannot be probed"""
+        key = probe_key(leaf)
+        if key is None and not leaf.pipe:
+            return None
+        info = self.cache.get(key) if key is not None else None
+        if info is not None:
+            return info
+        if leaf.pipe:
+            info = run('-', leaf.file)
+        else:
+            info = run(leaf.file)
+        if info is not None and key is not None:
+            self.cache.set(key, info)
+        return info
@@ -0,0 +1,267 @@
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+MAX_DEPTH = 64
+IDLE_CPU = 0.1  # Share of the interval a thread must have run for to be sampled as running
+# Python functions a thread sits in while it waits, its samples there are idle
+IDLE_FUNCTIONS = {('threading.py', 'wait'), ('threading.py', 'wait_for'), ('threading.py', '_wait_for_tstate_lock'),
+                  ('queue.py', 'get'), ('queue.py', 'put'), ('selectors.py', 'select'),
+                  ('socketserver.py', 'serve_forever')}
+
+
+def thread_label(thread):
+    """Names a thread after its class, or by its name for a plain Thread"""
+    if type(thread).__module__ == 'threading':
+        return thread.name
+    return type(thread).__name__
+
+
+def thread_cpu(ident):
+    """Returns the CPU time a thread used so far, or None where it cannot be
+    read
+    """
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+def code_name(code):
+    return '{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FUNCTIONS
+
+
+class Sampler(threading.Thread):
+    """Takes the stacks of every other thread of the process every interval
+    seconds with sys._current_frames, and counts how often each stack was
+    seen, until stopped or max_seconds passed. A thread whose CPU time barely
+    moved since the last sample, or waiting in IDLE_FUNCTIONS, is sampled as
+    idle, since Python frames do not show it sleeping in C. Calls done with
+    itself when it stops.
+    """
+    def __init__(self, interval, max_seconds, done):
+        threading.Thread.__init__(self)
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.done = done
+        self.daemon = True
+        self.stopping = threading.Event()
+        self.stacks = collections.Counter()  # (thread label, function names from the outermost) to samples
+        self.idle = collections.Counter()  # Thread label to samples waiting
+        self.cpu = {}  # Thread ident to its label and CPU time at the start
+        self.last = {}  # Thread ident to its CPU time at the last sample
+        self.names = {}  # Code object to its function name
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+
+    def run(self):
+        own = threading.get_ident()
+        self.started = time.monotonic()
+        for thread in threading.enumerate():
+            if thread.ident != own:
+                self.last[thread.ident] = thread_cpu(thread.ident)
+                self.cpu[thread.ident] = [thread_label(thread), self.last[thread.ident], None]
+        try:
+            while not self.stopping.wait(self.interval):
+                self.sample(own)
+                if time.monotonic() - self.started >= self.max_seconds:
+                    break
+        finally:
+            self.elapsed = time.monotonic() - self.started
+            labels = {thread.ident: thread_label(thread) for thread in threading.enumerate()}
+            for ident, times in self.cpu.items():
+                if ident in labels:
+                    times[2] = thread_cpu(ident)
+            self.done(self)
+
+    def sample(self, own):
+        labels = {thread.ident: thread_label(thread) for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            label = labels.get(ident, str(ident))
+            cpu = thread_cpu(ident)
+            if ident not in self.cpu:  # Started during the profile
+                self.cpu[ident] = [label, 0.0 if cpu is not None else None, None]
+            last = self.last.get(ident)
+            self.last[ident] = cpu
+            if is_idle(frame) or (cpu is not None and last is not None and
+                                  cpu - last < self.interval * IDLE_CPU):
+                self.idle[label] += 1
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_DEPTH:
+                code = frame.f_code
+                name = self.names.get(code)
+                if name is None:
+                    name = self.names[code] = code_name(code)
+                names.append(name)
+                frame = frame.f_back
+            self.stacks[(label, tuple(reversed(names)))] += 1
+        self.samples += 1
+
+    def stop(self):
+        self.stopping.set()
+
+
+class Profiler:
+    """Profiles every thread of the process on demand: a Sampler for where
+    they spend their time and tracemalloc for what they allocate while it
+    runs. Reports are written to folder when it stops, their summary is given
+    to the function passed to start.
+    """
+    def __init__(self, folder='profiles', interval=0.01, max_seconds=300, frames=25, top=10):
+        self.folder = folder
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.frames = frames
+        self.top = top
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.notify = None
+        self.tracing = False  # tracemalloc was started by the profiler
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns a profiler set from the profiler section of config.json"""
+        kwargs = {}
+        for key, cast in (('folder', str), ('interval', float), ('max_seconds', float),
+                          ('frames', int), ('top', int)):
+            try:
+                kwargs[key] = cast(config['profiler'][key])
+            except (KeyError, ValueError):
+                pass
+        return cls(**kwargs)
+
+    def running(self):
+        with self.lock:
+            return self.sampler is not None
+
+    def start(self, notify):
+        """Starts profiling, notify is called with the report once it stops.
+        Returns False if it is already running.
+        """
+        with self.lock:
+            if self.sampler is not None:
+                return False
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+                self.tracing = True
+            self.notify = notify
+            self.sampler = Sampler(self.interval, self.max_seconds, self.finished)
+            self.sampler.start()
+            return True
+
+    def stop(self):
+        """Stops profiling and waits for the report. Returns False if it was
+        not running.
+        """
+        with self.lock:
+            sampler = self.sampler
+        if sampler is None:
+            return False
+        sampler.stop()
+        sampler.join()
+        return True
+
+    def finished(self, sampler):
+        """Writes the reports of a stopped sampler and of tracemalloc, and
+        hands their summary to notify
+        """
+        snapshot = self.snapshot()
+        with self.lock:
+            if self.tracing:
+                tracemalloc.stop()
+                self.tracing = False
+            notify = self.notify
+            self.sampler = None
+            self.notify = None
+        try:
+            report = self.write(sampler, snapshot)
+        except OSError as e:
+            print('Could not write the profile: ' + str(e))
+            report = None
+        if notify is not None:
+            notify(report)
+
+    def snapshot(self):
+        """Returns the traces of the blocks allocated since tracemalloc
+        started and still alive, or None if it is not tracing
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, __file__)))
+
+    def memory(self):
+        """Returns the largest allocation sites while profiling, as a list of
+        (site, bytes, blocks), or None if it is not running
+        """
+        snapshot = self.snapshot() if self.running() else None
+        if snapshot is None:
+            return None
+        return [(str(stat.traceback[0]), stat.size, stat.count) for stat in snapshot.statistics('lineno')[:self.top]]
+
+    def write(self, sampler, snapshot):
+        """Writes the stacks in the collapsed format flame graph tools read,
+        a summary of the threads and functions and the allocation sites.
+        Returns the summary as a dict.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        base = os.path.join(self.folder, time.strftime('profile-%Y%m%d-%H%M%S'))
+        with open(base + '.collapsed', 'w') as f:
+            for (label, names), count in sorted(sampler.stacks.items()):
+                f.write('{0};{1} {2}\n'.format(label, ';'.join(names), count))
+
+        busy = collections.Counter()  # Thread label to samples not waiting
+        own = collections.Counter()  # Function to samples it was running in
+        total = collections.Counter()  # Function to samples it was on the stack
+        for (label, names), count in sampler.stacks.items():
+            busy[label] += count
+            own[names[-1]] += count
+            for name in set(names):
+                total[name] += count
+        cpu = collections.Counter()
+        for label, start, end in sampler.cpu.values():
+            if start is not None and end is not None:
+                cpu[label] += end - start
+        memory = []
+        if snapshot is not None:
+            memory = [(str(stat.traceback[0]), stat.size, stat.count) for stat in
+                      snapshot.statistics('lineno')[:self.top]]
+        report = {'files': [base + '.txt', base + '.collapsed'], 'seconds': sampler.elapsed,
+                  'samples': sampler.samples, 'threads': cpu.most_common(self.top),
+                  'functions': own.most_common(self.top), 'memory': memory}
+
+        with open(base + '.txt', 'w') as f:
+            f.write('{0} samples over {1:.1f} s, every {2} s\n'.format(sampler.samples, sampler.elapsed,
+                                                                    sampler.interval))
+            f.write('\nThreads: CPU seconds, samples running, samples waiting\n')
+            for label in sorted(set(busy) | set(sampler.idle) | set(cpu), key=lambda x: -cpu.get(x, 0)):
+                f.write('{0:>10.3f} {1:>8} {2:>8}  {3}\n'.format(cpu.get(label, 0), busy[label],
+                                                                  sampler.idle[label], label))
+            f.write('\nFunctions: samples running, samples on the stack\n')
+            for name, count in own.most_common():
+                f.write('{0:>8} {1:>8}  {2}\n'.format(count, total[name], name))
+            f.write('\nCumulative: samples on the stack\n')
+            for name, count in total.most_common(50):
+                f.write('{0:>8}  {1}\n'.format(count, name))
+            if snapshot is not None:
+                f.write('\nAllocated while profiling and still alive: bytes, blocks, site\n')
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('{0:>12} {1:>8}  {2}\n'.format(stat.size, stat.count, stat.traceback[0]))
+                f.write('\nLargest allocation sites by traceback\n')
+                for stat in snapshot.statistics('traceback')[:self.top]:
+                    f.write('\n{0} bytes in {1} blocks\n'.format(stat.size, stat.count))
+                    for line in stat.traceback.format():
+                        f.write(line + '\n')
+        return report